@@ -0,0 +1,131 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import json
+
+# Pillow is optional; without it images are not packed into atlases
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def shelf_pack(sizes, atlas_size):
+    # Packs (name, width, height) rectangles into as few atlases as possible by filling rows (shelves) of images of
+    # decreasing height. Returns a list of atlases, each a list of (name, x, y, width, height).
+    atlases = []
+    current = []
+    x = y = shelf_height = 0
+    for name, width, height in sorted(sizes, key=lambda s: (-s[2], -s[1], s[0])):
+        if x + width > atlas_size:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if y + height > atlas_size:
+            atlases.append(current)
+            current = []
+            x = y = shelf_height = 0
+        current.append((name, x, y, width, height))
+        x += width
+        shelf_height = max(shelf_height, height)
+    if current:
+        atlases.append(current)
+    return atlases
+
+
+def list_assets(assets_path, exclude_path):
+    asset_files = []
+    for root, dirs, files in os.walk(assets_path):
+        dirs.sort()
+        for f in sorted(files):
+            file_path = os.path.join(root, f)
+            if not os.path.abspath(file_path).startswith(os.path.abspath(exclude_path) + os.sep):
+                asset_files.append(file_path.replace('\\', '/'))
+    return asset_files
+
+
+def pack_images(image_files, assets_path, output_path, max_image_size, atlas_size):
+    # Small PNG images are combined into PNG atlases; other image types are left alone since repacking them as PNG
+    # would lose their compression
+    sizes = []
+    images = {}
+    for file_path in image_files:
+        image = Image.open(file_path)
+        if image.width <= max_image_size and image.height <= max_image_size:
+            name = os.path.relpath(file_path, assets_path).replace('\\', '/')
+            images[name] = image
+            sizes.append((name, image.width, image.height))
+
+    frames = {}
+    output_files = []
+    for atlas in shelf_pack(sizes, atlas_size):
+        if len(atlas) < 2:
+            continue                            # nothing is saved by packing a single image
+        atlas_name = 'atlas-{0}.png'.format(len(output_files))
+        width = max(x + w for name, x, y, w, h in atlas)
+        height = max(y + h for name, x, y, w, h in atlas)
+        atlas_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for name, x, y, w, h in atlas:
+            atlas_image.paste(images[name].convert('RGBA'), (x, y))
+            frames[name] = {'atlas': 'packed/' + atlas_name, 'x': x, 'y': y, 'width': w, 'height': h}
+        atlas_file = os.path.join(output_path, atlas_name).replace('\\', '/')
+        atlas_image.save(atlas_file, optimize=True)
+        output_files.append(atlas_file)
+    return frames, output_files
+
+
+def pack_json(json_files, assets_path, output_path, max_json_size, max_bundle_size):
+    # Small JSON files are combined into bundles that map each file's name to its content
+    bundles = [{}]
+    bundle_sizes = [0]
+    for file_path in json_files:
+        size = os.path.getsize(file_path)
+        if size > max_json_size:
+            continue
+        if bundle_sizes[-1] + size > max_bundle_size:
+            bundles.append({})
+            bundle_sizes.append(0)
+        with open(file_path, 'r', encoding='utf-8') as f:
+            bundles[-1][os.path.relpath(file_path, assets_path).replace('\\', '/')] = json.load(f)
+        bundle_sizes[-1] += size
+
+    entries = {}
+    output_files = []
+    for bundle in bundles:
+        if len(bundle) < 2:
+            continue
+        bundle_name = 'bundle-{0}.json'.format(len(output_files))
+        bundle_file = os.path.join(output_path, bundle_name).replace('\\', '/')
+        with open(bundle_file, 'w', encoding='utf-8') as f:
+            json.dump(bundle, f, separators=(',', ':'), sort_keys=True)
+        for name in bundle:
+            entries[name] = {'bundle': 'packed/' + bundle_name, 'key': name}
+        output_files.append(bundle_file)
+    return entries, output_files
+
+
+def pack_assets(assets_path, output_path, max_image_size=128, atlas_size=2048, max_json_size=16384, max_bundle_size=262144):
+    # Writes atlases, bundles and a manifest.json to output_path, replacing any previous output. The manifest is
+    # read by AssetManager.loadManifest and locates each packed asset by its path relative to the assets directory.
+    if os.path.exists(output_path):
+        for f in os.listdir(output_path):
+            os.remove(os.path.join(output_path, f))
+    else:
+        os.makedirs(output_path)
+
+    asset_files = list_assets(assets_path, output_path)
+    manifest = {'images': {}, 'json': {}}
+    output_files = []
+    if Image is not None:
+        image_files = [f for f in asset_files if os.path.splitext(f)[1].lower() == '.png']
+        manifest['images'], atlas_files = pack_images(image_files, assets_path, output_path, max_image_size, atlas_size)
+        output_files.extend(atlas_files)
+    json_files = [f for f in asset_files if os.path.splitext(f)[1].lower() == '.json']
+    manifest['json'], bundle_files = pack_json(json_files, assets_path, output_path, max_json_size, max_bundle_size)
+    output_files.extend(bundle_files)
+
+    manifest_file = os.path.join(output_path, 'manifest.json').replace('\\', '/')
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    output_files.append(manifest_file)
+    return manifest, output_files
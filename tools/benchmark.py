@@ -0,0 +1,200 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+PURPOSE = """\
+benchmark.py [options]                Time website.py pipeline functions against synthetic source trees
+
+Options:
+  --sizes small,medium,large          Tree sizes to benchmark (default small,medium)
+  --repeat N                          Repetitions of each measurement; the fastest is reported (default 5)
+  --save                              Save results as the new baseline
+  --baseline FILE                     Baseline file (default .cache/benchmark.json)
+  --threshold PERCENT                 Slowdown against the baseline reported as a regression (default 20)
+
+upload_file is timed against moto's in process S3 stand-in when moto is installed and is skipped otherwise.
+Exits with an error if any measurement regresses against the baseline."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+
+import website
+import dependency_graph
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+# Tree sizes as (JS classes, CSS files, asset files)
+tree_sizes = {
+    'small': (50, 10, 50),
+    'medium': (500, 50, 500),
+    'large': (2000, 200, 2000)
+}
+
+# Length of each extends chain; chains are shuffled together so that file order differs from dependency order
+chain_length = 20
+
+asset_types = ['.png', '.jpg', '.json', '.txt']
+
+
+def write_file(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+
+def generate_tree(root_path, class_count, css_count, asset_count, seed=1):
+    # Generated content depends only on the seed so that runs are comparable
+    rng = random.Random(seed)
+    names = ['Class{0:05d}'.format(i) for i in range(class_count)]
+    order = list(range(class_count))
+    rng.shuffle(order)
+    for position, index in enumerate(order):
+        extends = ' extends ' + names[index - 1] if index % chain_length else ''
+        source = 'class {0}{1} {{\n    constructor() {{\n{2}        this.value = {3};\n    }}\n}}\n'.format(
+            names[index], extends, '        super();\n' if extends else '', index)
+        directory = 'module{0:02d}'.format(position % 16)
+        write_file(os.path.join(root_path, 'source', directory, names[index].lower() + '.js'), source.encode('utf-8'))
+
+    for i in range(css_count):
+        rules = ''.join('.c{0}-{1} {{ margin: {1}px; background: url("../image{1}.png"); }}\n'.format(i, j) for j in range(20))
+        write_file(os.path.join(root_path, 'source', 'style{0:03d}'.format(i), 'style.css'), rules.encode('utf-8'))
+
+    for i in range(asset_count):
+        extension = asset_types[i % len(asset_types)]
+        if extension in ('.png', '.jpg'):
+            data = bytes(rng.getrandbits(8) for _ in range(2048))
+        elif extension == '.json':
+            data = json.dumps({'id': i, 'values': list(range(200))}).encode('utf-8')
+        else:
+            data = ('line {0}\n'.format(i) * 200).encode('utf-8')
+        write_file(os.path.join(root_path, 'assets', 'group{0:02d}'.format(i % 8), 'asset{0:05d}{1}'.format(i, extension)), data)
+
+    with open(website.website_path + '/index.html', 'rb') as f:
+        write_file(os.path.join(root_path, 'index.html'), f.read())
+
+
+def measure(func, repeat, setup=None):
+    # Returns the fastest of repeat runs in seconds; setup is run untimed before each run
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_tree(root_path, repeat):
+    results = {}
+    source_path = os.path.join(root_path, 'source').replace('\\', '/')
+    assets_path = os.path.join(root_path, 'assets').replace('\\', '/')
+    html_path = os.path.join(root_path, 'index.html')
+
+    results['list_files'] = measure(lambda: website.list_files(root_path), repeat)
+    js_files = website.list_files(source_path, extensions=['.js'])
+    css_files = website.list_files(source_path, extensions=['.css'])
+    results['sort_js (uncached)'] = measure(lambda: dependency_graph.sort_js_files(js_files), repeat)
+    graph_cache_file = os.path.join(root_path, 'dependency_graph.json')
+    results['sort_js (cached)'] = measure(lambda: dependency_graph.sort_js_files(js_files, graph_cache_file), repeat)
+    sorted_files = dependency_graph.sort_js_files(js_files, graph_cache_file)
+    results['populate_html'] = measure(lambda: website.populate_html(html_path, sorted_files, css_files), repeat)
+    html_data = website.populate_html(html_path, sorted_files, css_files)
+    results['bake_html_version'] = measure(lambda: website.bake_html_version(html_data, 'VERSION'), repeat)
+
+    if mock_aws is not None:
+        asset_files = website.list_files(assets_path)
+        with mock_aws():
+            client = website.create_client('us-west-2')
+            client.create_bucket(Bucket='benchmark', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+            # Compressed files are cleared before each run so that compression is included, and then measured
+            # separately as cache hits
+            upload_all = lambda: [website.upload_file(client, f, 'benchmark', f[len(root_path) + 1:]) for f in asset_files]
+            results['upload_file'] = measure(
+                upload_all, repeat, lambda: shutil.rmtree(website.compressed_cache_path, ignore_errors=True))
+            results['upload_file (cached)'] = measure(upload_all, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Prints each measurement with its change against the baseline and returns the regressed measurements
+    regressions = []
+    print('{0:<8} {1:<28} {2:>10} {3:>10} {4:>8}'.format('Size', 'Measurement', 'Time (ms)', 'Baseline', 'Change'))
+    for size, measurements in results.items():
+        for name, seconds in measurements.items():
+            baseline_seconds = baseline.get(size, {}).get(name)
+            if baseline_seconds:
+                change = 100.0 * (seconds - baseline_seconds) / baseline_seconds
+                flag = '  REGRESSION' if change > threshold else ''
+                if flag:
+                    regressions.append(size + ' ' + name)
+                print('{0:<8} {1:<28} {2:>10.2f} {3:>10.2f} {4:>+7.1f}%{5}'.format(
+                    size, name, seconds * 1000, baseline_seconds * 1000, change, flag))
+            else:
+                print('{0:<8} {1:<28} {2:>10.2f} {3:>10} {4:>8}'.format(size, name, seconds * 1000, '', ''))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    sizes = ['small', 'medium']
+    repeat = 5
+    save = False
+    baseline_file = website.cache_path + '/benchmark.json'
+    threshold = 20.0
+    args = sys.argv[1:]
+    try:
+        while args:
+            option = args.pop(0)
+            if option == '--sizes':
+                sizes = args.pop(0).split(',')
+            elif option == '--repeat':
+                repeat = int(args.pop(0))
+            elif option == '--save':
+                save = True
+            elif option == '--baseline':
+                baseline_file = args.pop(0)
+            elif option == '--threshold':
+                threshold = float(args.pop(0))
+            else:
+                sys.exit(PURPOSE)
+    except (IndexError, ValueError):
+        sys.exit(PURPOSE)
+    if any(size not in tree_sizes for size in sizes):
+        sys.exit(PURPOSE)
+    if mock_aws is None:
+        print("upload_file not measured; requires moto module, try 'pip install moto'")
+
+    # Compressed files are cached in the temporary directory so that the build cache is left untouched
+    results = {}
+    temp_path = tempfile.mkdtemp(prefix='benchmark-')
+    website.compressed_cache_path = os.path.join(temp_path, 'compressed')
+    try:
+        for size in sizes:
+            root_path = os.path.join(temp_path, size).replace('\\', '/')
+            generate_tree(root_path, *tree_sizes[size])
+            results[size] = benchmark_tree(root_path, repeat)
+    finally:
+        shutil.rmtree(temp_path)
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, threshold)
+
+    if save:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(baseline_file), exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print('Saved baseline to ' + baseline_file)
+    elif regressions:
+        sys.exit('Regressions against baseline: ' + ', '.join(regressions))
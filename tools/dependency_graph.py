@@ -0,0 +1,380 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import re
+import json
+import heapq
+import hashlib
+
+# Increment when parse output changes so that cached parse results are discarded
+parser_version = 3
+
+keywords = {
+    'await', 'break', 'case', 'catch', 'class', 'const', 'continue', 'debugger', 'default', 'delete', 'do', 'else',
+    'export', 'extends', 'false', 'finally', 'for', 'function', 'if', 'import', 'in', 'instanceof', 'let', 'new',
+    'null', 'of', 'return', 'static', 'super', 'switch', 'this', 'throw', 'true', 'try', 'typeof', 'undefined',
+    'var', 'void', 'while', 'with', 'yield'
+}
+
+# Keywords after which a '/' starts a regular expression literal rather than a division
+regex_keywords = {'case', 'delete', 'do', 'else', 'in', 'instanceof', 'new', 'of', 'return', 'throw', 'typeof', 'void', 'yield'}
+
+token_patterns = [
+    ('space',   re.compile(r'\s+')),
+    ('comment', re.compile(r'//[^\n]*|/\*.*?(?:\*/|$)', re.S)),
+    ('string',  re.compile(r'"(?:\\.|[^"\\\n])*"?|\'(?:\\.|[^\'\\\n])*\'?|`(?:\\.|[^`\\])*`?', re.S)),
+    ('name',    re.compile(r'[A-Za-z_$][\w$]*')),
+    ('number',  re.compile(r'\.?\d[\w.]*')),
+    ('regex',   re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*')),
+    ('punct',   re.compile(r'=>|\.\.\.|\S'))
+]
+
+
+class DependencyError(Exception):
+    pass
+
+
+def tokenize(source):
+    # Yields (kind, text, line) for each significant token; comments and whitespace are dropped
+    position = 0
+    line = 1
+    previous = None
+    while position < len(source):
+        for kind, pattern in token_patterns:
+            if kind == 'regex' and previous is not None:
+                # A '/' following a value is a division operator
+                previous_kind, previous_text = previous
+                if previous_kind in ('number', 'string', 'regex') or previous_text in (')', ']', '}'):
+                    continue
+                if previous_kind == 'name' and previous_text not in regex_keywords:
+                    continue
+            match = pattern.match(source, position)
+            if match:
+                break
+        text = match.group(0)
+        if kind not in ('space', 'comment'):
+            yield kind, text, line
+            previous = (kind, text)
+        line += text.count('\n')
+        position = match.end()
+
+
+def template_expressions(text):
+    # Returns the source of each ${...} substitution within a template literal
+    expressions = []
+    position = 1
+    while position < len(text):
+        if text[position] == '\\':
+            position += 2
+        elif text.startswith('${', position):
+            start = position + 2
+            brace_depth = 1
+            quote = None
+            position = start
+            while position < len(text) and brace_depth:
+                character = text[position]
+                if character == '\\':
+                    position += 1
+                elif quote:
+                    if character == quote:
+                        quote = None
+                elif character in '"\'`':
+                    quote = character
+                elif character == '{':
+                    brace_depth += 1
+                elif character == '}':
+                    brace_depth -= 1
+                position += 1
+            expressions.append(text[start:position - 1])
+        else:
+            position += 1
+    return expressions
+
+
+def expand_templates(tokens):
+    # Substitutions within template literals are evaluated with the surrounding code, so their tokens are inserted
+    # as a parenthesized expression ahead of the template literal itself
+    for kind, text, line in tokens:
+        if kind == 'string' and text.startswith('`'):
+            for expression in template_expressions(text):
+                yield 'punct', '(', line
+                yield from expand_templates(tokenize(expression))
+                yield 'punct', ')', line
+        yield kind, text, line
+
+
+# Keywords that are followed by a parenthesized header and then a block, e.g. 'if (...) {'
+header_keywords = {'if', 'for', 'while', 'switch', 'catch', 'with'}
+
+# Keywords that are followed directly by a block
+block_keywords = {'else', 'try', 'finally', 'do'}
+
+# Words that may precede a property name within an object literal, e.g. 'get name() {...}'
+property_modifiers = {'get', 'set', 'async', '*'}
+
+# Keywords after which a '{' starts an object literal
+expression_keywords = {'return', 'typeof', 'yield', 'await', 'in', 'of', 'case', 'void', 'delete', 'throw', 'instanceof', 'new'}
+
+
+class Context:
+    # An open brace. Load references made within it are added to sink, or discarded where sink is None because the
+    # code runs later; a function body collects its references separately until it is known whether it is invoked
+    # immediately.
+
+    def __init__(self, kind, sink, paren_depth):
+        self.kind = kind                # 'block', 'object', 'function' or 'class'
+        self.sink = sink
+        self.paren_depth = paren_depth
+        self.local_names = set()
+
+
+def is_property_name(contexts, tokens, index, previous):
+    # Property names within object literals, e.g. 'name' in '{name: value}' or '{name() {...}}', are not references;
+    # shorthand properties, as in '{name}', are
+    if not contexts or contexts[-1].kind != 'object' or (previous not in (',', '{') and previous not in property_modifiers):
+        return False
+    following = tokens[index + 1] if index + 1 < len(tokens) else (None, None, None)
+    return following[1] in (':', '(') or (following[0] == 'name' and tokens[index][1] in property_modifiers)
+
+
+def parse_js(source):
+    # Records top level declarations, class inheritance and identifier references for a single source file.
+    # References that execute when the file loads - at the top level of the file, including within blocks, object
+    # literals, template literal substitutions and immediately invoked functions - require the files declaring them
+    # to be loaded first; the same applies to superclasses. References within function and class bodies run later.
+    # Only statement level declarations are recorded, so that e.g. the loop variable in 'for (let i = 0; ...)' is not
+    # mistaken for one.
+    declarations = {}
+    var_names = set()
+    local_names = set()         # declared within a statement header or top level block, e.g. a loop variable
+    superclasses = {}
+    references = set()
+    load_references = set()
+    contexts = []               # open braces
+    parens = []                 # token preceding each open parenthesis or bracket
+    paren_depth = 0
+    groups = []                 # load references first made within each open parenthesis or bracket
+    closed_group = set()
+    name_groups = []            # all names within each open parenthesis or bracket
+    closed_names = set()
+    parameters = set()          # parameters of an arrow function whose body follows
+    closed_opener = None        # token preceding the most recently closed parenthesis
+    previous_added = False      # previous token was a name first added to load references
+    arrow = False               # previous token was a load time '=>'
+    arrow_body = None           # (contexts, paren_depth) of a load time arrow function's expression body
+    class_header = False
+    previous = None
+    previous_kind = None
+    class_name = None
+    tokens = list(expand_templates(tokenize(source)))
+    for index, (kind, text, line) in enumerate(tokens):
+        sink = contexts[-1].sink if contexts else load_references
+        if arrow:
+            arrow = False
+            if text != '{':
+                arrow_body = (len(contexts), paren_depth)
+        added = False
+        if kind == 'punct':
+            if text == '{':
+                if class_header:
+                    context = Context('class', None, paren_depth)
+                    class_header = False
+                elif previous == '=>' or (previous == ')' and closed_opener not in header_keywords):
+                    # Function parameters are not references
+                    if previous == ')' and sink is not None:
+                        sink -= closed_group
+                    context = Context('function', set() if sink is not None else None, paren_depth)
+                    context.local_names |= parameters if previous == '=>' else closed_names
+                elif previous == ')' or previous is None or previous in (';', '{', '}') or previous in block_keywords:
+                    if previous == ')' and closed_opener == 'catch' and sink is not None:
+                        sink -= closed_group
+                        local_names.update(closed_names)
+                    context = Context('block', sink, paren_depth)
+                elif (previous_kind == 'punct' and previous != ']') or previous in expression_keywords:
+                    context = Context('object', sink, paren_depth)
+                else:
+                    context = Context('block', sink, paren_depth)
+                contexts.append(context)
+            elif text == '}' and contexts:
+                context = contexts.pop()
+                sink = contexts[-1].sink if contexts else load_references
+                if context.kind == 'function' and context.sink is not None and sink is not None:
+                    # Invoked immediately, as in '(function () { ... })()' or '(function () { ... }())'
+                    following = [t[1] for t in tokens[index + 1:index + 3]]
+                    if following[:2] == [')', '('] or (following[:1] == ['('] and context.paren_depth > 0):
+                        sink |= context.sink - context.local_names
+                if arrow_body is not None and len(contexts) < arrow_body[0]:
+                    arrow_body = None
+            elif text in ('(', '['):
+                paren_depth += 1
+                parens.append(previous)
+                groups.append(set())
+                name_groups.append(set())
+            elif text in (')', ']'):
+                paren_depth -= 1
+                closed_opener = parens.pop() if parens else None
+                closed_group = groups.pop() if groups else set()
+                if groups:
+                    groups[-1] |= closed_group
+                closed_names = name_groups.pop() if name_groups else set()
+                if name_groups:
+                    name_groups[-1] |= closed_names
+                if arrow_body is not None and (len(contexts), paren_depth) < arrow_body:
+                    arrow_body = None
+            elif text in (';', ',') and (len(contexts), paren_depth) == arrow_body:
+                arrow_body = None
+            elif text == '=>' and sink is not None:
+                # Arrow function parameters are not references
+                if previous == ')':
+                    sink -= closed_group
+                    parameters = closed_names
+                else:
+                    if previous_added:
+                        sink.discard(previous)
+                    parameters = {previous}
+                arrow = True
+        elif kind == 'name' and text not in keywords and previous != '.' and not is_property_name(contexts, tokens, index, previous):
+            if name_groups:
+                name_groups[-1].add(text)
+            if previous in ('class', 'function', 'const', 'let', 'var'):
+                if not contexts and paren_depth == 0:
+                    declarations.setdefault(text, line)
+                    if previous == 'var':
+                        var_names.add(text)
+                else:
+                    functions = [c for c in contexts if c.kind == 'function']
+                    if functions:
+                        functions[-1].local_names.add(text)
+                    else:
+                        local_names.add(text)
+                if previous == 'class':
+                    class_name = text
+            elif previous == 'extends':
+                if class_name:
+                    superclasses[class_name] = text
+                references.add(text)
+                if sink is not None:
+                    sink.add(text)
+            else:
+                references.add(text)
+                if sink is not None and arrow_body is None and text not in sink:
+                    sink.add(text)
+                    added = True
+                    if groups:
+                        groups[-1].add(text)
+        if text == 'class':
+            class_name = None
+            class_header = True
+        previous = text
+        previous_kind = kind
+        previous_added = added
+    return {
+        'declarations': declarations,
+        'var_names': sorted(var_names),
+        'superclasses': superclasses,
+        'references': sorted(references - set(declarations) - local_names),
+        'load_references': sorted(load_references - set(declarations) - local_names)
+    }
+
+
+def parse_js_files(file_paths, cache_file=None):
+    # Parse results are cached by file size and modification time, falling back to a content hash comparison
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        if cache.get('parser_version') != parser_version:
+            cache = {}
+    files = cache.setdefault('files', {})
+    cache['parser_version'] = parser_version
+
+    results = {}
+    changed = False
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        entry = files.get(file_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            results[file_path] = entry['parse']
+            continue
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if entry and entry['sha256'] == digest:
+            parse = entry['parse']
+        else:
+            parse = parse_js(data.decode('utf-8'))
+        files[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest, 'parse': parse}
+        results[file_path] = parse
+        changed = True
+
+    if cache_file and changed:
+        for file_path in [k for k in files if not os.path.exists(k)]:
+            del files[file_path]
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    return results
+
+
+def build_graph(file_paths, parsed):
+    # Returns a map of each file to the files it depends on at load time, with the name that causes each dependency
+    # A var may be declared again in another file; the first declaration is used
+    declared_in = {}
+    for file_path in file_paths:
+        for name, line in parsed[file_path]['declarations'].items():
+            if name in declared_in:
+                if name in parsed[file_path]['var_names'] and name in parsed[declared_in[name]]['var_names']:
+                    continue
+                raise DependencyError('{0} declared in both {1} and {2}:{3}'.format(name, declared_in[name], file_path, line))
+            declared_in[name] = file_path
+
+    dependencies = {}
+    for file_path in file_paths:
+        dependencies[file_path] = {}
+        for name in parsed[file_path]['load_references']:
+            dependency = declared_in.get(name)
+            if dependency and dependency != file_path:
+                dependencies[file_path].setdefault(dependency, name)
+    return dependencies
+
+
+def find_cycle(dependencies, remaining):
+    # Follow dependencies between unsorted files until a file repeats
+    path = [min(remaining)]
+    while True:
+        next_file = min(d for d in dependencies[path[-1]] if d in remaining)
+        if next_file in path:
+            return path[path.index(next_file):] + [next_file]
+        path.append(next_file)
+
+
+def sort_js_files(file_paths, cache_file=None):
+    # Topological sort so that each file follows the files it depends on; otherwise input order is preserved
+    parsed = parse_js_files(file_paths, cache_file)
+    dependencies = build_graph(file_paths, parsed)
+    dependents = {file_path: [] for file_path in file_paths}
+    pending_counts = {}
+    for file_path, file_dependencies in dependencies.items():
+        pending_counts[file_path] = len(file_dependencies)
+        for dependency in file_dependencies:
+            dependents[dependency].append(file_path)
+
+    order = {file_path: index for index, file_path in enumerate(file_paths)}
+    ready = [(order[f], f) for f in file_paths if pending_counts[f] == 0]
+    heapq.heapify(ready)
+    output_file_list = []
+    while ready:
+        file_path = heapq.heappop(ready)[1]
+        output_file_list.append(file_path)
+        for dependent in dependents[file_path]:
+            pending_counts[dependent] -= 1
+            if pending_counts[dependent] == 0:
+                heapq.heappush(ready, (order[dependent], dependent))
+
+    if len(output_file_list) != len(file_paths):
+        remaining = set(file_paths) - set(output_file_list)
+        cycle = find_cycle(dependencies, remaining)
+        steps = ['{0} (uses {1})'.format(f, dependencies[f][n]) for f, n in zip(cycle, cycle[1:])]
+        raise DependencyError('Circular dependency: ' + ' -> '.join(steps + [cycle[-1]]))
+    return output_file_list
@@ -0,0 +1,184 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import gzip
+import asyncio
+from urllib.parse import urlsplit, unquote
+
+# Pages served as HTML have this script inserted so that they reload when a watched file changes
+live_reload_path = '/__livereload'
+live_reload_script = '<script>new EventSource("' + live_reload_path + '").onmessage = function () { location.reload(); };</script>'
+
+status_text = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class DevServer:
+
+    def __init__(self, root_path, mime_types, gzip_types, gzip_levels=None, aliases=None, snapshot=None, on_change=None):
+        # aliases maps request paths to files outside root_path; snapshot returns a value that changes whenever a
+        # watched file changes, and on_change is called (on a worker thread) before clients are told to reload
+        self.root_path = os.path.abspath(root_path)
+        self.mime_types = mime_types
+        self.gzip_types = gzip_types
+        self.gzip_levels = gzip_levels or {}
+        self.aliases = aliases or {}
+        self.snapshot = snapshot
+        self.on_change = on_change
+        self.cache = {}
+        self.clients = set()
+
+    def resolve(self, request_path):
+        # Returns the file for a request path, or None where it does not exist or lies outside the root
+        if request_path in self.aliases:
+            file_path = os.path.abspath(self.aliases[request_path])
+        else:
+            file_path = os.path.abspath(os.path.join(self.root_path, request_path.lstrip('/')))
+            if file_path != self.root_path and not file_path.startswith(self.root_path + os.sep):
+                return None
+            if os.path.isdir(file_path):
+                file_path = os.path.join(file_path, 'index.html')
+        return file_path if os.path.isfile(file_path) else None
+
+    def load(self, file_path):
+        # Responses are cached in memory until the file's size or modification time changes. As in production, files
+        # of gzip types are always sent compressed.
+        stat = os.stat(file_path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        entry = self.cache.get(file_path)
+        if entry and entry[0] == key:
+            return entry[1], entry[2]
+
+        extension = os.path.splitext(file_path)[1]
+        headers = {'Content-Type': self.mime_types.get(extension, 'binary/octet-stream'), 'Cache-Control': 'no-cache'}
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        if extension in ('.htm', '.html'):
+            body = self.inject_live_reload(body)
+        if extension in self.gzip_types:
+            level = self.gzip_levels.get(extension, 9)
+            body = gzip.compress(body, 9 if level == 'zopfli' else level, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        headers['ETag'] = '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns)
+        self.cache[file_path] = (key, headers, body)
+        return headers, body
+
+    @staticmethod
+    def inject_live_reload(body):
+        index = body.lower().rfind(b'</body>')
+        if index == -1:
+            index = len(body)
+        return body[:index] + live_reload_script.encode('utf-8') + body[index:]
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive; only GET and HEAD are supported
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                request_headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin_1').partition(':')
+                    request_headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin_1').split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, {}, b'')
+                    break
+                method, target, version = parts
+                keep_alive = version == 'HTTP/1.1' and request_headers.get('connection', '').lower() != 'close'
+                request_path = unquote(urlsplit(target).path)
+                if method not in ('GET', 'HEAD'):
+                    await self.respond(writer, 405, {'Allow': 'GET, HEAD'}, b'')
+                elif request_path == live_reload_path:
+                    await self.stream_events(writer)
+                    break
+                else:
+                    file_path = self.resolve(request_path)
+                    if file_path is None:
+                        status, headers, body = 404, {'Content-Type': 'text/plain'}, b'Not found'
+                    else:
+                        headers, body = self.load(file_path)
+                        status = 200
+                        if request_headers.get('if-none-match') == headers['ETag']:
+                            status, headers, body = 304, {'ETag': headers['ETag']}, b''
+                    await self.respond(writer, status, headers, body, method == 'HEAD')
+                    print('{0} {1} {2}'.format(method, request_path, status))
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, headers, body, head_only=False):
+        lines = ['HTTP/1.1 {0} {1}'.format(status, status_text[status])]
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        lines.append('Content-Length: {0}'.format(len(body)))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin_1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def stream_events(self, writer):
+        # Server-sent events; a comment is sent periodically so that closed connections are noticed
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+        await writer.drain()
+        events = asyncio.Queue()
+        self.clients.add(events)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), 15)
+                    writer.write('data: {0}\n\n'.format(event).encode('utf-8'))
+                except asyncio.TimeoutError:
+                    writer.write(b': keep-alive\n\n')
+                await writer.drain()
+        finally:
+            self.clients.discard(events)
+
+    async def watch(self, interval):
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, self.snapshot)
+        while True:
+            await asyncio.sleep(interval)
+            current = await loop.run_in_executor(None, self.snapshot)
+            if current == snapshot:
+                continue
+
+            # Wait for the file set to settle so that a multi-file save results in a single reload
+            await asyncio.sleep(interval)
+            settled = await loop.run_in_executor(None, self.snapshot)
+            if settled != current:
+                continue
+            if self.on_change:
+                try:
+                    await loop.run_in_executor(None, self.on_change)
+                except Exception as e:
+                    print(e)                # report errors and keep serving
+            snapshot = await loop.run_in_executor(None, self.snapshot)
+            self.cache.clear()
+            print('Change detected; reloading {0} page(s)'.format(len(self.clients)))
+            for events in self.clients:
+                events.put_nowait('reload')
+
+    async def run(self, host, port, interval):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('Serving {0} at http://{1}:{2}/; press Ctrl+C to stop'.format(self.root_path, host, port))
+        async with server:
+            if self.snapshot:
+                asyncio.ensure_future(self.watch(interval))
+            await server.serve_forever()
+
+
+def serve(root_path, mime_types, gzip_types, gzip_levels=None, aliases=None, snapshot=None, on_change=None,
+          host='127.0.0.1', port=8000, interval=0.5):
+    server = DevServer(root_path, mime_types, gzip_types, gzip_levels, aliases, snapshot, on_change)
+    try:
+        asyncio.run(server.run(host, port, interval))
+    except KeyboardInterrupt:
+        print('Stopped')
@@ -0,0 +1,164 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import zlib
+import shutil
+import struct
+import tempfile
+import subprocess
+
+# Pillow is optional; it is only required for WebP variants
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+# Ancillary chunks that affect how an image is displayed; all other ancillary chunks (text, timestamps, physical
+# dimensions, background colour etc.) are removed
+png_display_chunks = [b'PLTE', b'tRNS', b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'sBIT']
+
+# PNG optimizers used, in order of preference, to re-filter and recompress image data where one is installed
+png_optimizers = [('oxipng', ['-o', '2', '--quiet']), ('optipng', ['-o2', '-quiet'])]
+
+
+def read_png_chunks(data):
+    # Raises ValueError where the data is not a complete PNG file
+    if data[:8] != png_signature:
+        raise ValueError('Not a PNG file')
+    chunks = []
+    position = 8
+    while position < len(data):
+        if position + 12 > len(data):
+            raise ValueError('Truncated PNG chunk')
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        if position + 12 + length > len(data):
+            raise ValueError('Truncated PNG chunk')
+        chunks.append((chunk_type, data[position + 8:position + 8 + length]))
+        position += 12 + length
+        if chunk_type == b'IEND':
+            break
+    if not chunks or chunks[0][0] != b'IHDR' or chunks[-1][0] != b'IEND':
+        raise ValueError('Incomplete PNG file')
+    return chunks
+
+
+def is_animated_png(data):
+    # An APNG is a PNG with an animation control chunk, which must precede the image data
+    try:
+        return any(chunk_type == b'acTL' for chunk_type, chunk_data in read_png_chunks(data))
+    except ValueError:
+        return False
+
+
+def write_png_chunk(chunk_type, chunk_data):
+    crc = zlib.crc32(chunk_type + chunk_data) & 0xffffffff
+    return struct.pack('>I4s', len(chunk_data), chunk_type) + chunk_data + struct.pack('>I', crc)
+
+
+def smallest_deflate(raw):
+    candidates = []
+    for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidates.append(compressor.compress(raw) + compressor.flush())
+    return min(candidates, key=len)
+
+
+def optimize_png(data):
+    # Lossless: pixel data is unchanged. Non-display chunks are removed and the image data is recompressed, keeping
+    # whichever encoding is smallest; the existing row filters are kept. Animated PNGs and files that cannot be
+    # parsed are returned unchanged.
+    try:
+        chunks = read_png_chunks(data)
+        raw = zlib.decompress(b''.join(d for t, d in chunks if t == b'IDAT'))
+    except (ValueError, zlib.error):
+        return data
+    if any(chunk_type == b'acTL' for chunk_type, chunk_data in chunks):
+        return data
+    header = chunks[0][1]
+    output = [png_signature, write_png_chunk(b'IHDR', header)]
+    for chunk_type, chunk_data in chunks:
+        if chunk_type in png_display_chunks:
+            output.append(write_png_chunk(chunk_type, chunk_data))
+    output.append(write_png_chunk(b'IDAT', smallest_deflate(raw)))
+    output.append(write_png_chunk(b'IEND', b''))
+    optimized = b''.join(output)
+    return recompress_png(optimized if len(optimized) < len(data) else data)
+
+
+def recompress_png(data):
+    # Re-filters and recompresses the image data through oxipng or optipng where one is installed; neither removes
+    # any chunks by default
+    for name, options in png_optimizers:
+        optimizer = shutil.which(name)
+        if optimizer is not None:
+            break
+    else:
+        return data
+    file_descriptor, temp_file = tempfile.mkstemp(suffix='.png')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(data)
+        result = subprocess.run([optimizer] + options + [temp_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(temp_file, 'rb') as f:
+            optimized = f.read()
+    finally:
+        os.remove(temp_file)
+    if result.returncode != 0 or not optimized or len(optimized) >= len(data):
+        return data
+    return optimized
+
+
+def has_exif(data):
+    # Scans the JPEG header segments for an APP1 Exif segment, which may hold the image orientation
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xff:
+        marker = data[position + 1]
+        if marker == 0xda:                              # start of scan; no more header segments
+            break
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        if marker == 0xe1 and data[position + 4:position + 10] == b'Exif\x00\x00':
+            return True
+        position += 2 + length
+    return False
+
+
+def optimize_jpeg(file_path):
+    # Lossless Huffman table optimization through jpegtran where it is installed. The ICC profile is always kept so that
+    # colours are unchanged, and all metadata is kept where there is Exif data since it may set the orientation.
+    jpegtran = shutil.which('jpegtran')
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if jpegtran is None:
+        return data
+    copy = 'all' if has_exif(data) else 'icc'
+    result = subprocess.run([jpegtran, '-copy', copy, '-optimize', file_path], stdout=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout or len(result.stdout) >= len(data):
+        return data
+    return result.stdout
+
+
+def optimize_image(file_path, output_file, webp_file=None):
+    # Process pool worker; writes the optimized image (and optionally a lossless WebP variant) and returns
+    # (original size, optimized size, webp size)
+    extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, 'rb') as f:
+        original = f.read()
+    data = optimize_png(original) if extension == '.png' else optimize_jpeg(file_path)
+
+    # Outputs are written under a temporary name so that an interrupted run never leaves a partial file in the cache
+    with open(output_file + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(output_file + '.tmp', output_file)
+
+    # No WebP variant is made for an animated PNG, which would lose its animation, or for an image Pillow cannot read
+    webp_size = None
+    if webp_file and Image is not None and not is_animated_png(original):
+        try:
+            Image.open(file_path).save(webp_file + '.tmp', 'WEBP', lossless=(extension == '.png'), quality=90, method=6)
+        except OSError:
+            return len(original), len(data), None
+        os.replace(webp_file + '.tmp', webp_file)
+        webp_size = os.path.getsize(webp_file)
+    return len(original), len(data), webp_size
@@ -0,0 +1,99 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import re
+
+# Whitespace between two of these elements is rendered so it is collapsed rather than removed
+inline_elements = {
+    'a', 'abbr', 'b', 'bdi', 'bdo', 'button', 'cite', 'code', 'data', 'dfn', 'em', 'i', 'img', 'input', 'kbd',
+    'label', 'mark', 'q', 's', 'samp', 'select', 'small', 'span', 'strong', 'sub', 'sup', 'textarea', 'time', 'u', 'var'
+}
+
+# Strings and comments are matched whole so that their content is never mistaken for syntax
+css_token_pattern = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/|\s+|.', re.S)
+
+# Matches from a ':' to the end of a declaration, distinguishing it from a pseudo-class within a selector
+css_declaration_pattern = re.compile(r'[^{};]*[;}]')
+
+# Comments, elements with raw content (whose content is left untouched), doctype and tags; a '<' not followed by a
+# letter, '/' or '!' is text
+html_token_pattern = re.compile(
+    r'(<!--.*?-->)|(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\3\s*>)|(<!DOCTYPE[^>]*>)|(<(?:/?[a-zA-Z]|!)[^>]*>)',
+    re.S | re.I)
+
+
+def minify_css_text(css_data):
+    # Remove comments (other than /*! licence comments) and redundant whitespace. Whitespace before ':' is only
+    # removed within declarations since it is significant in selectors (e.g. 'div :hover'); whitespace around '+'
+    # and '-' is kept as it is required within calc().
+    output = []
+    space = False
+    for match in css_token_pattern.finditer(css_data):
+        token = match.group(0)
+        if token.startswith('/*') and not token.startswith('/*!'):
+            space = True
+            continue
+        if token.isspace():
+            space = True
+            continue
+        if space and output:
+            previous = output[-1][-1]
+            in_declaration = token == ':' and css_declaration_pattern.match(css_data, match.start())
+            if previous not in '{};,>~:(' and token not in '{};,>~)' and not in_declaration:
+                output.append(' ')
+        space = False
+        if token == '}' and output and output[-1] == ';':
+            output.pop()
+        output.append(token)
+    return ''.join(output)
+
+
+def minify_html_text(html_data):
+    # Collapse whitespace, remove comments and redundant script type attributes, and minify inline styles. Content
+    # of pre, textarea and script elements is left untouched. Conditional comments are preserved.
+    output = []
+    position = 0
+    previous_name = None
+    for match in html_token_pattern.finditer(html_data):
+        comment, raw_open, raw_name, raw_content, raw_close, doctype, tag = match.groups()
+        name = tag_name(raw_open or tag or '')
+        text = html_data[position:match.start()]
+        if not text.isspace() or (previous_name in inline_elements and name in inline_elements):
+            output.append(collapse_whitespace(text))
+        position = match.end()
+        if not comment:
+            previous_name = name
+        if comment:
+            if comment.startswith('<!--[if'):
+                output.append(comment)
+        elif raw_open:
+            raw_name = raw_name.lower()
+            if raw_name == 'script':
+                raw_open = re.sub(r'\s+type\s*=\s*["\']?text/javascript["\']?', '', raw_open, flags=re.I)
+            elif raw_name == 'style':
+                raw_content = minify_css_text(raw_content)
+            output.append(minify_tag(raw_open) + raw_content + raw_close)
+        elif doctype:
+            output.append('<!doctype html>')
+        else:
+            output.append(minify_tag(tag))
+    output.append(collapse_whitespace(html_data[position:]))
+    return ''.join(output).strip()
+
+
+def tag_name(tag):
+    match = re.match(r'</?([a-zA-Z0-9]+)', tag)
+    return match.group(1).lower() if match else None
+
+
+def collapse_whitespace(text):
+    return re.sub(r'\s+', ' ', text)
+
+
+def minify_tag(tag):
+    # Collapse whitespace between attributes outside of quoted values
+    parts = re.split(r'("[^"]*"|\'[^\']*\')', tag)
+    for index in range(0, len(parts), 2):
+        parts[index] = re.sub(r'\s+', ' ', parts[index])
+        parts[index] = re.sub(r'\s*=\s*', '=', parts[index])
+        parts[index] = re.sub(r'\s+(/?>)$', r'\1', parts[index])
+    return ''.join(parts)
@@ -0,0 +1,80 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Profiler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+        self.metrics = {}
+
+    def add(self, name, seconds=0.0, bytes_in=0, bytes_out=0, requests=0, calls=1):
+        with self.lock:
+            metric = self.metrics.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'requests': 0})
+            metric['calls'] += calls
+            metric['seconds'] += seconds
+            metric['bytes_in'] += bytes_in
+            metric['bytes_out'] += bytes_out
+            metric['requests'] += requests
+
+    @contextmanager
+    def stage(self, name):
+        # Times the enclosed block; byte counts may be added to the yielded dict by the caller
+        counts = {'bytes_in': 0, 'bytes_out': 0}
+        start_time = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - start_time, counts['bytes_in'], counts['bytes_out'])
+
+    def attach(self, client):
+        # Count and time every API call made through a boto3 client; nested by thread since clients are shared
+        def before_call(model, **kwargs):
+            if not hasattr(self.local, 'calls'):
+                self.local.calls = []
+            self.local.calls.append(time.perf_counter())
+
+        def after_call(model, **kwargs):
+            start_time = self.local.calls.pop()
+            self.add('s3 ' + model.name, time.perf_counter() - start_time, requests=1)
+
+        def before_send(**kwargs):
+            self.add('s3 http requests', requests=1, calls=0)      # includes retries
+
+        client.meta.events.register('before-call.s3', before_call)
+        client.meta.events.register('after-call.s3', after_call)
+        client.meta.events.register('before-send.s3', before_send)
+        return client
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        stages = {}
+        for name, metric in sorted(self.metrics.items()):
+            stages[name] = dict(metric)
+            if metric['bytes_in'] and metric['bytes_out']:
+                stages[name]['ratio'] = metric['bytes_out'] / metric['bytes_in']
+        return {'elapsed': elapsed, 'stages': stages}
+
+    def report_json(self):
+        return json.dumps(self.report())
+
+    def report_table(self):
+        report = self.report()
+        lines = ['{0:<32} {1:>6} {2:>9} {3:>14} {4:>14} {5:>6} {6:>9}'.format(
+            'Stage', 'Calls', 'Time (s)', 'Bytes in', 'Bytes out', 'Ratio', 'Requests')]
+        for name, metric in report['stages'].items():
+            ratio = '{0:.2f}'.format(metric['ratio']) if 'ratio' in metric else ''
+            lines.append('{0:<32} {1:>6} {2:>9.2f} {3:>14,} {4:>14,} {5:>6} {6:>9}'.format(
+                name, metric['calls'], metric['seconds'], metric['bytes_in'], metric['bytes_out'], ratio, metric['requests']))
+        lines.append('Total elapsed {0:.2f}s; stage times are cumulative across threads'.format(report['elapsed']))
+        return '\n'.join(lines)
+
+
+# Single global instance shared by all build stages
+profiler = Profiler()
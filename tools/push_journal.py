@@ -0,0 +1,64 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import json
+import threading
+
+
+class PushJournal:
+    # Records each object uploaded by a push, one JSON line per object after a header line identifying the version,
+    # so that an interrupted push can be resumed. Lines are flushed as they are written so that a failure loses at
+    # most the uploads in progress.
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.completed = {}
+        self.file = None
+
+    def load(self):
+        # Returns the (version_id, description) of an interrupted push, or None
+        if not os.path.exists(self.file_path):
+            return None
+        header = None
+        with open(self.file_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break                               # last line was only partly written
+                if header is None:
+                    header = entry
+                else:
+                    self.completed[entry['key']] = entry
+        if header is None:
+            return None
+        return header['version_id'], header['description']
+
+    def start(self, version_id, description):
+        # Begins a new journal, or rewrites a loaded one without any partly written line, then appends from there
+        directory = os.path.dirname(self.file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.file_path, 'w') as f:
+            f.write(json.dumps({'version_id': version_id, 'description': description}) + '\n')
+            for entry in self.completed.values():
+                f.write(json.dumps(entry) + '\n')
+        self.file = open(self.file_path, 'a')
+
+    def lookup(self, object_key, sha256):
+        # Returns the ETag of an object already uploaded from content with the given hash, or None
+        entry = self.completed.get(object_key)
+        return entry['etag'] if entry and entry['sha256'] == sha256 else None
+
+    def record(self, object_key, sha256, etag):
+        entry = {'key': object_key, 'sha256': sha256, 'etag': etag}
+        with self.lock:
+            self.completed[object_key] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def finish(self):
+        # The push is complete so there is nothing left to resume
+        self.file.close()
+        os.remove(self.file_path)
@@ -5,36 +5,83 @@ import sys
 import re
 import io
 import gzip
+import zlib
+import json
+import queue
+import threading
 import base64
+import posixpath
+import fnmatch
+import hashlib
+import time
 import subprocess
 import tempfile
+import webbrowser
 import datetime
 import xml.etree.ElementTree as ET
-from urllib.request import urlopen
-from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from dependency_graph import sort_js_files, parse_js_files, DependencyError
+from profiler import profiler
+from minify import minify_css_text, minify_html_text
+from push_journal import PushJournal
 
+# Boto3 is imported by create_client on first use so that local commands neither require it nor pay its import time;
+# likewise the dev server, asset packing and image optimization modules are imported by the functions that use them
+boto3 = Config = ClientError = None
+
+# Optional compressors; only required when enabled in configuration.xml
+try:
+    import brotli
+except ImportError:
+    brotli = None
 try:
-    import boto3
-    from botocore.config import Config
-    from botocore.exceptions import ClientError
+    import zopfli.gzip
 except ImportError:
-    sys.exit("Requires Boto3 module; try 'pip install boto3'")
+    zopfli = None
+
+# Site and cache paths are resolved from the location of this file so that it may be run, or its functions called,
+# from any directory
+script_path = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/')
+root_path = posixpath.dirname(script_path)
+website_path = root_path + '/website'
+cache_path = root_path + '/.cache'
 
 PURPOSE = """\
-website.py list                       List site versions
+website.py list [--refresh]           List site versions
 website.py reindex                    Rebuild index.html
 website.py compile                    Compile javascript code
+website.py build                      Compile javascript code and build CSS
+website.py pack                       Pack small assets into atlases and bundles
+website.py optimize                   Optimize images and report size savings
+website.py watch                      Recompile javascript code on change
 website.py lint                       Lint javascript code
 website.py push <description>         Push a site version
+website.py push --resume              Resume an interrupted push
+website.py verify <version_id>        Check a version's objects against its manifest
 website.py deploy <version_id>        Deploy specified version to live
-website.py delete <version_ids...>    Delete site versions
+website.py delete <version_ids...>    Delete site versions; hashed code files they use are kept until a prune
+website.py prune [--keep <count>] [--older-than <days>]
+                                      Delete all but the newest versions and/or versions older than given days,
+                                      then hashed code files over a day old that no remaining version uses
 website.py view <version_id>          View a site version
+website.py serve [--port <port>]      Serve website locally, reloading pages on change
+
+Any command accepts --profile or --profile=json to report time spent in each build stage
 
 where,
+   --refresh       Ignore locally cached version metadata
    <description>   Text description for site version
    <version_id>    Version identifier
 """
 
+# Site settings, read from configuration.xml by configure(). The module may also be imported and driven through
+# configure(), build(), push() and deploy(), which raise WebsiteError on failure rather than exiting.
+region = None
+bucket_name = None
+closure_version = None
+upload_concurrency = 10
+endpoint_url = None
+
 # ContentEncoding for file types
 mime_types = {
     '.txt':  'text/plain; charset=utf-8',
@@ -54,6 +101,7 @@ mime_types = {
     '.jpg':  'image/jpeg',
     '.jpeg': 'image/jpeg',
     '.png':  'image/png',
+    '.webp': 'image/webp',
     '.tiff': 'image/tiff',
     '.oga':  'audio/ogg',
     '.mp4a': 'audio/mp4',
@@ -65,6 +113,82 @@ mime_types = {
 # These file types are gzip compressed before upload
 gzip_types = ['.txt', '.htm', '.html', '.css', '.csv', '.js', '.json']
 
+# Gzip compression level for each file type; 1-9 or 'zopfli'. Types not listed use level 9.
+gzip_levels = {}
+
+# These file types also have a brotli compressed variant uploaded alongside with a '.br' suffix
+brotli_types = []
+brotli_quality = 11
+
+# Compressed file data is cached by content hash so that high ratio compression is paid once per unique file
+compressed_cache_path = cache_path + '/compressed'
+
+# Files larger than the threshold are compressed and uploaded in parts rather than buffered in memory
+multipart_threshold = 16 * 1048576
+multipart_part_size = 8 * 1048576       # S3 requires at least 5MB for all parts but the last
+
+# Patterns for rewriting references in HTML tags and CSS; comments and the content of raw text elements are matched
+# whole so that tag-like text within them is never rewritten
+html_tag_pattern = re.compile(
+    r'(<!--.*?-->)|(<(script|style|textarea|title)\b[^>]*>)(.*?)(</\3\s*>)|(<[a-zA-Z][^>]*>)', re.S | re.I)
+html_attribute_pattern = re.compile(r'(\s(?:src|href))(\s*=\s*)(?:(["\'])(.*?)\3|([^\s"\'>]+))', re.I)
+css_url_pattern = re.compile(r'url\(\s*(["\']?)([^"\')]*)\1\s*\)', re.I)
+
+# HTML and CSS minifier; 'builtin' minifies in process, 'external' uses the html-minifier and uglifycss npm tools
+minifier = 'builtin'
+
+# Location of build outputs
+build_path = cache_path + '/build'
+
+# Small images and JSON assets are packed into atlases and bundles when enabled in configuration.xml
+pack_enabled = False
+pack_options = {}
+pack_path = cache_path + '/packed'
+
+# Image files are losslessly optimized before upload when enabled in configuration.xml; optimized images and their
+# optional WebP variants are cached by content hash
+image_types = ['.png', '.jpg', '.jpeg']
+image_optimize_enabled = False
+image_webp = False
+image_cache_path = cache_path + '/images'
+
+# Cache-Control rules as (key pattern, content type pattern, value); the first rule matching an object applies and
+# objects matching no rule use cache_default. Rules are replaced by the cache element in configuration.xml.
+cache_rules = [('index.html', None, 'public,max-age=300')]
+cache_default = 'public,max-age=31536000'
+
+# When enabled index.js and index.css are uploaded outside the version prefix with their content hash in the file
+# name, so that unchanged files keep the same URL from one version to the next
+hashed_names_enabled = False
+hashed_prefix = 'hashed/'
+
+# Cache of file content hashes keyed by path
+hash_cache_file = cache_path + '/hashes.json'
+hash_cache = {}
+
+# Lint results are cached by file content and linter options; generated jshint configurations are kept alongside
+lint_cache_file = cache_path + '/lint.json'
+lint_path = cache_path + '/lint'
+csslint_options = ['--quiet', '--format=compact', '--ignore=order-alphabetical,fallback-colors,compatible-vendor-prefixes,font-sizes']
+
+# Exit codes of each linter for a completed run; jshint exits with 2 and csslint with 1 where problems are found
+jshint_exit_codes = (0, 2)
+csslint_exit_codes = (0, 1)
+
+# Summary line written by jshint's unix reporter after the messages, e.g. '3 errors'
+lint_summary_pattern = re.compile(r'\d+ errors?$')
+
+# Uploads completed by a push in progress, used to resume the push if it is interrupted
+journal_file = cache_path + '/journal-{0}.json'
+
+# Local cache of site version metadata used by the list command
+version_cache_file = cache_path + '/versions-{0}.json'
+
+
+# Raised by build, push and other operations on failure; the command line reports the message and exits
+class WebsiteError(Exception):
+    pass
+
 
 # A timemark encodes the current date and time into a base32 string
 def encode_timemark():
@@ -87,10 +211,28 @@ def encode_timemark():
     return year + month + day + '-' + timestamp
 
 
+# Decodes a timemark back into a UTC datetime; the year is taken as the most recent match since timemarks wrap
+def decode_timemark(timemark):
+    base_year = 2020
+    encoding = '0123456789ACDEFGHJKLMNPQRSTVWXYZ'
+    now = datetime.datetime.utcnow()
+    year = base_year + encoding.index(timemark[0])
+    while year + 32 <= now.year:
+        year += 32
+    month = encoding.index(timemark[1])
+    day = encoding.index(timemark[2])
+    time_increment = 0
+    for digit in timemark[4:8]:
+        time_increment = (time_increment << 5) | encoding.index(digit)
+    microseconds_since_midnight = (time_increment * 86400000000) // 1048576
+    return datetime.datetime(year, month, day) + datetime.timedelta(microseconds=microseconds_since_midnight)
+
+
 def list_files(path, extensions=None):
     file_list = []
     for root, dirs, files in os.walk(path):
-        for f in files:
+        dirs.sort()                                     # walk in a consistent order on all platforms
+        for f in sorted(files):
             ext = os.path.splitext(f)[1]
             if not extensions or ext in extensions:
                 file_path = os.path.join(root, f)
@@ -99,64 +241,31 @@ def list_files(path, extensions=None):
     return file_list
 
 
-def sort_js_by_class_hierarchy(file_paths):
-    # Load each source file and identify class inheritance
-    class_to_file_map = {}
-    class_hierarchy_chain = {}
-    output_file_list = []
-    for file_path in file_paths:
-        with open(file_path, 'r') as f:
-            inheritance_found = False
-            for line in f.read().splitlines():
-                match = re.search(r'class\s+(.*)\s+extends\s+(.*)\s+', line)
-                if match:
-                    class_name = match.group(1)
-                    superclass_name = match.group(2)
-                    class_to_file_map[class_name] = file_path
-                    class_hierarchy_chain[class_name] = [superclass_name]
-                    inheritance_found = True
-                    break
-            if not inheritance_found:
-                output_file_list.append(file_path)
-
-    # Complete the inheritance chain for each class
-    for class_name, chain in class_hierarchy_chain.items():
-        superclass_name = chain[0]
-        while superclass_name:
-            if superclass_name in class_hierarchy_chain:
-                next_class = class_hierarchy_chain[superclass_name][0]
-                class_hierarchy_chain[class_name].append(next_class)
-                superclass_name = next_class
-            else:
-                superclass_name = None
+def site_path(file_path):
+    # Path of a file relative to the website directory, as referenced from index.html and used in object keys
+    return posixpath.relpath(file_path, website_path)
 
-    # Sort classes in inheritance order
-    ordered_class_list = []
-    for class_name, chain in class_hierarchy_chain.items():
-        for superclass_name in reversed(chain):
-            if superclass_name not in ordered_class_list:
-                ordered_class_list.append(superclass_name)
-        if class_name not in ordered_class_list:
-            ordered_class_list.append(class_name)
 
-    # Generate file list with superclasses preceding classes
-    for class_name in ordered_class_list:
-        if class_name in class_hierarchy_chain:
-            output_file_list.append(class_to_file_map[class_name])
-    return output_file_list
+def sort_js_by_class_hierarchy(file_paths):
+    # Order source files so that superclasses and other load time dependencies precede the files that use them
+    try:
+        return sort_js_files(file_paths, cache_path + '/dependency_graph.json')
+    except DependencyError as e:
+        raise WebsiteError('Error: ' + str(e))
 
 
 def download_closure_compiler(closure_version):
-    script_path = os.path.abspath(os.path.dirname(sys.argv[0]))
-    jar_path = os.path.join(script_path, '..', '.cache', 'closure')
+    jar_path = cache_path + '/closure'
     jar_file = os.path.join(jar_path, 'closure-compiler-' + closure_version + '.jar').replace('\\', '/')
     if not os.path.exists(jar_file):
+        from urllib.request import urlopen                  # imported here as it is only needed once
+        from urllib.error import HTTPError, URLError
         jar_url = 'https://repo1.maven.org/maven2/com/google/javascript/closure-compiler/' + closure_version + '/closure-compiler-' + closure_version + '.jar'
         try:
             fp = urlopen(jar_url)
             body = fp.read()
         except (HTTPError, URLError):
-            sys.exit('Failed to download closure compiler')
+            raise WebsiteError('Failed to download closure compiler')
         if not os.path.exists(jar_path):
             os.makedirs(jar_path)
         with open(jar_file, 'wb') as f:
@@ -164,32 +273,60 @@ def download_closure_compiler(closure_version):
     return jar_file
 
 
-def compile_javascript(closure_version):
-    js_files = list_files('../website/source', extensions=['.js'])
+def hash_build_inputs(js_files, extern_files, flags, closure_version):
+    # Build key covers everything that affects compiler output; source order matters so file paths are included
+    sha = hashlib.sha256()
+    sha.update(closure_version.encode('utf-8'))
+    sha.update('\0'.join(flags).encode('utf-8'))
+    for file_path in extern_files + ['--'] + js_files:
+        sha.update(b'\0' + file_path.encode('utf-8'))
+        if file_path != '--':
+            sha.update(hash_file(file_path).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def compile_javascript(closure_version, java_options=()):
+    js_files = list_files(website_path + '/source', extensions=['.js'])
     js_files = sort_js_by_class_hierarchy(js_files)
-    compiled_file = '../.cache/compiled.js'
+    extern_files = list_files(website_path + '/externs')
+    compiled_file = cache_path + '/compiled.js'
+    key_file = cache_path + '/compiled.key'
+    flags = [
+        '--compilation_level', 'ADVANCED',
+        '--language_in', 'ECMASCRIPT_2015',
+        '--language_out', 'ECMASCRIPT_2015',
+        '--strict_mode_input',
+        '--warning_level', 'VERBOSE']
+
+    # Reuse previous output if none of the compiler inputs have changed
+    build_key = hash_build_inputs(js_files, extern_files, flags, closure_version)
+    if os.path.exists(compiled_file) and os.path.exists(key_file):
+        with open(key_file, 'r') as f:
+            if f.read() == build_key:
+                return compiled_file
+
     if not os.path.exists(os.path.dirname(compiled_file)):
         os.makedirs(os.path.dirname(compiled_file))
     if os.path.exists(compiled_file):
         os.remove(compiled_file)
+    if os.path.exists(key_file):
+        os.remove(key_file)
     jar_path = download_closure_compiler(closure_version)
-    args = [
-        'java', '-jar', jar_path,
-        '--compilation_level', 'ADVANCED',
-        '--language_in', 'ECMASCRIPT_2015',
-        '--language_out', 'ECMASCRIPT_2015',
-        '--strict_mode_input',
-        '--warning_level', 'VERBOSE',
-        '--js_output_file', compiled_file]
-    for extern_file in list_files('../website/externs'):
+    args = ['java'] + list(java_options) + ['-jar', jar_path] + flags + ['--js_output_file', compiled_file]
+    for extern_file in extern_files:
         args.extend(['--externs', extern_file])
     args.extend(js_files)
     try:
-        subprocess.call(args)
+        with profiler.stage('closure compiler') as counts:
+            subprocess.call(args)
+            counts['bytes_in'] = sum(os.path.getsize(f) for f in js_files)
+            counts['bytes_out'] = os.path.getsize(compiled_file) if os.path.exists(compiled_file) else 0
     except OSError:
-        sys.exit('ERROR: Java not installed; install and try again')
+        raise WebsiteError('ERROR: Java not installed; install and try again')
     if not os.path.exists(compiled_file):
-        sys.exit('Javascript compilation failed')
+        raise WebsiteError('Javascript compilation failed')
+    with open(key_file, 'w') as f:
+        f.write(build_key)
     return compiled_file
 
 
@@ -223,113 +360,755 @@ def populate_html(html_path, js_files, css_files):
     return '\n'.join(output_lines)
 
 
-def bake_html_version(html_data, version_id):
-
-    # Make version ID available to javascript
-    html_data = html_data.replace('window["versionID"]="";', 'window["versionID"]="{0}";'.format(version_id))
+def write_if_changed(file_path, data):
+    # Leave unchanged files untouched so their modification time does not trigger watchers
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as f:
+            if f.read() == data:
+                return False
+    with open(file_path, 'w') as f:
+        f.write(data)
+    return True
 
-    # Find href and src references
-    match = re.findall(r"(src|href)\s*=\s*[\"|']([a-zA-Z0-9 \-._/'!@#$%^&()]+)[\"|']", html_data)
-    if match is not None:
-        # Create a unique set from the found reference names
-        matches = [x[-1] for x in match]
-        matches = set(matches)
 
-        # For each reference name check if it's a relative or absolute path
-        for name in matches:
-            if name[0:2] == '//':
-                continue
-            if name[0:4].lower() == 'http':
-                continue
-            # If the path is relative then remap it to the version path
-            html_data = html_data.replace(name, version_id + '/' + name)
-    return html_data
+def reindex_html():
+    js_files = list_files(website_path + '/source', extensions=['.js'])
+    js_files = sort_js_by_class_hierarchy(js_files)
+    js_files = [site_path(f) for f in js_files]
+    css_files = list_files(website_path + '/source', extensions=['.css'])
+    css_files = [site_path(f) for f in css_files]
+    populated_data = populate_html(website_path + '/index.html', js_files, css_files)
+    write_if_changed(website_path + '/index.html', populated_data)
+
+    js_files = ['../.cache/compiled.js']
+    populated_data = populate_html(website_path + '/index.html', js_files, css_files)
+    write_if_changed(website_path + '/compiled.html', populated_data)
+
+
+def snapshot_files(paths):
+    snapshot = {}
+    for path in paths:
+        for file_path in list_files(path):
+            try:
+                snapshot[file_path] = os.stat(file_path).st_mtime_ns
+            except OSError:
+                pass        # file removed while scanning
+    return snapshot
+
+
+def watch(closure_version, interval=0.5):
+    # Closure Compiler has no resident mode so each build is a fresh JVM; startup cost is reduced by limiting the JIT
+    # to its quick first tier, and the build cache skips the JVM entirely when a change does not affect compiler input
+    java_options = ['-XX:TieredStopAtLevel=1', '-Xshare:auto']
+    watched_paths = [website_path + '/source', website_path + '/externs']
+    snapshot = None
+    print('Watching ' + ', '.join(watched_paths) + '; press Ctrl+C to stop')
+    try:
+        while True:
+            current = snapshot_files(watched_paths)
+            if current != snapshot:
+                # Wait for the file set to settle so that a multi-file save results in a single build
+                time.sleep(interval)
+                settled = snapshot_files(watched_paths)
+                if settled != current:
+                    continue
+                snapshot = settled
+                start_time = time.perf_counter()
+                try:
+                    reindex_html()
+                    compile_javascript(closure_version, java_options)
+                    save_hash_cache()
+                    print('Compiled in {0:.2f}s'.format(time.perf_counter() - start_time))
+                except WebsiteError as e:
+                    print(e)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def pack_website_assets():
+    import asset_pack
+    with profiler.stage('pack assets'):
+        manifest, output_files = asset_pack.pack_assets(website_path + '/assets', pack_path, **pack_options)
+    if asset_pack.Image is None:
+        print("Images not packed; image atlases require Pillow module, try 'pip install Pillow'")
+    print('Packed {0} images and {1} JSON files into {2} files'.format(
+        len(manifest['images']), len(manifest['json']), len(output_files) - 1))
+    return output_files
+
+
+def optimize_images(file_paths, webp=False):
+    # Returns a map of each image path to its optimized file and WebP variant (or None). Images not already in the
+    # cache are optimized by a process pool across all cores.
+    import multiprocessing
+    import image_optimize
+    from concurrent.futures import ProcessPoolExecutor
+    if webp and image_optimize.Image is None:
+        print("WebP variants not created; requires Pillow module, try 'pip install Pillow'")
+        webp = False
+    optimized_files = {}
+    jobs = {}
+    for file_path in file_paths:
+        digest = hash_file(file_path)
+        output_file = os.path.join(image_cache_path, digest + os.path.splitext(file_path)[1].lower()).replace('\\', '/')
+        webp_file = os.path.join(image_cache_path, digest + '.webp').replace('\\', '/') if webp else None
+        optimized_files[file_path] = (output_file, webp_file)
+        if not os.path.exists(output_file) or (webp_file and not os.path.exists(webp_file)):
+            jobs.setdefault(output_file, (file_path, output_file, webp_file))
+
+    if jobs:
+        if not os.path.exists(image_cache_path):
+            os.makedirs(image_cache_path)
+        with profiler.stage('optimize images') as counts:
+            # Workers are spawned rather than forked since this runs on a stage thread of a multi-threaded process
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(image_optimize.optimize_image, *job): job[0] for job in jobs.values()}
+                for future in as_completed(futures):
+                    original_size, optimized_size, webp_size = future.result()
+                    counts['bytes_in'] += original_size
+                    counts['bytes_out'] += optimized_size
+                    webp_report = '  webp {0:,}'.format(webp_size) if webp_size is not None else ''
+                    print('{0:>12,} -> {1:>12,}{2}  {3}'.format(original_size, optimized_size, webp_report, futures[future]))
+
+    # WebP variants are not made for animated or unreadable images
+    for file_path, (output_file, webp_file) in optimized_files.items():
+        if webp_file and not os.path.exists(webp_file):
+            optimized_files[file_path] = (output_file, None)
+
+    # Display size summary
+    original_total = sum(os.path.getsize(f) for f in optimized_files)
+    optimized_total = sum(os.path.getsize(f[0]) for f in optimized_files.values())
+    saving = 100.0 * (original_total - optimized_total) / original_total if original_total else 0.0
+    print('Optimized {0} images ({1} cached), {2:,} -> {3:,} bytes ({4:.1f}% smaller)'.format(
+        len(optimized_files), len(optimized_files) - len(jobs), original_total, optimized_total, saving))
+    return optimized_files
+
+
+def is_relative_path(path):
+    # Excludes empty paths, fragments, root relative and protocol relative paths, and URLs with a scheme
+    return path != '' and path[0] not in '/#' and not re.match(r'[a-zA-Z][a-zA-Z0-9+.-]*:', path)
+
+
+def bake_html_version(html_data, version_id, path_map=None, unversioned_paths=(), packed=False):
+
+    # Make version ID available to javascript, along with whether the version includes packed assets
+    script = 'window["versionID"]="{0}";'.format(version_id)
+    if packed:
+        script += 'window["packedAssets"]=true;'
+    html_data = html_data.replace('window["versionID"]="";', script)
+
+    # Rewrite relative src and href attribute values to the version path in a single pass over the document; values
+    # are substituted through path_map first and those in unversioned_paths are left as they are. Only attributes
+    # within tags are matched; comments and script, style, textarea and title content are left as they are.
+    path_map = path_map or {}
+
+    def rewrite_attribute(match):
+        quote = match.group(3) or ''
+        path = match.group(4) if quote else match.group(5)
+        path = path_map.get(path, path)
+        if is_relative_path(path) and path not in unversioned_paths:
+            path = version_id + '/' + path
+        return match.group(1) + match.group(2) + quote + path + quote
+
+    def rewrite_tag(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return html_attribute_pattern.sub(rewrite_attribute, match.group(2)) + match.group(4) + match.group(5)
+        return html_attribute_pattern.sub(rewrite_attribute, match.group(6))
+
+    return html_tag_pattern.sub(rewrite_tag, html_data)
+
+
+def rebase_css_urls(css_data, css_path):
+    # Rewrites relative url() references in a CSS file at css_path (relative to the site root) so that they resolve
+    # from the site root, as required once the file is combined into index.css
+    css_dir = posixpath.dirname(css_path)
+
+    def rewrite_url(match):
+        quote, path = match.group(1), match.group(2).strip()
+        if is_relative_path(path):
+            path = posixpath.normpath(posixpath.join(css_dir, path))
+        return 'url(' + quote + path + quote + ')'
+
+    return css_url_pattern.sub(rewrite_url, css_data)
 
 
 def minify_html(input_file, output_file):
     try:
-        subprocess.call(
-            [
-                # see https://www.npmjs.com/package/html-minifier
-                'html-minifier.cmd' if sys.platform == 'win32' else 'html-minifier',
-                '--collapse-whitespace',
-                '--remove-comments',
-                '--remove-optional-tags',
-                '--remove-redundant-attributes',
-                '--remove-script-type-attributes',
-                '--use-short-doctype',
-                '-o', output_file,
-                input_file
-            ]
-        )
+        with profiler.stage('html-minifier') as counts:
+            counts['bytes_in'] = os.path.getsize(input_file)
+            subprocess.call(
+                [
+                    # see https://www.npmjs.com/package/html-minifier
+                    'html-minifier.cmd' if sys.platform == 'win32' else 'html-minifier',
+                    '--collapse-whitespace',
+                    '--remove-comments',
+                    '--remove-optional-tags',
+                    '--remove-redundant-attributes',
+                    '--remove-script-type-attributes',
+                    '--use-short-doctype',
+                    '-o', output_file,
+                    input_file
+                ]
+            )
+            counts['bytes_out'] = os.path.getsize(output_file) if os.path.exists(output_file) else 0
     except OSError:
-        sys.exit("HTML Minify not installed; try 'npm install -g html-minifier'")
+        raise WebsiteError("HTML Minify not installed; try 'npm install -g html-minifier'")
 
 
 def minify_css(input_file, output_file):
     try:
-        subprocess.call(
-            [
-                'uglifycss.cmd' if sys.platform == 'win32' else 'uglifycss',
-                '--output', output_file,
-                input_file
-            ]
-        )
+        with profiler.stage('uglifycss') as counts:
+            counts['bytes_in'] = os.path.getsize(input_file)
+            subprocess.call(
+                [
+                    'uglifycss.cmd' if sys.platform == 'win32' else 'uglifycss',
+                    '--output', output_file,
+                    input_file
+                ]
+            )
+            counts['bytes_out'] = os.path.getsize(output_file) if os.path.exists(output_file) else 0
     except OSError:
-        sys.exit("UglifyCSS is not installed; try 'npm install -g uglifycss'")
+        raise WebsiteError("UglifyCSS is not installed; try 'npm install -g uglifycss'")
+
+
+def minify_css_data(css_data):
+    # CSS is minified in process unless the external uglifycss tool is configured
+    if minifier == 'external':
+        return _minify_external(minify_css, css_data, '.css')
+    with profiler.stage('minify css') as counts:
+        counts['bytes_in'] = len(css_data)
+        css_data = minify_css_text(css_data)
+        counts['bytes_out'] = len(css_data)
+    return css_data
+
+
+def minify_html_data(html_data):
+    # HTML is minified in process unless the external html-minifier tool is configured
+    if minifier == 'external':
+        return _minify_external(minify_html, html_data, '.html')
+    with profiler.stage('minify html') as counts:
+        counts['bytes_in'] = len(html_data)
+        html_data = minify_html_text(html_data)
+        counts['bytes_out'] = len(html_data)
+    return html_data
 
 
-def upload_file(client, file_path, bucket_name, object_key):
+def _minify_external(minify_function, data, extension):
+    # Temporary files are created securely with mkstemp; the output file is overwritten by the minifier
+    input_descriptor, input_file = tempfile.mkstemp(suffix=extension)
+    output_descriptor, output_file = tempfile.mkstemp(suffix=extension)
+    os.close(output_descriptor)
+    try:
+        with os.fdopen(input_descriptor, 'w') as f:
+            f.write(data)
+        minify_function(input_file, output_file)
+        with open(output_file, 'r') as f:
+            return f.read()
+    finally:
+        os.remove(input_file)
+        os.remove(output_file)
+
+
+def write_build_file(file_name, data):
+    # Build outputs are written under .cache/build for upload
+    file_path = os.path.join(build_path, file_name).replace('\\', '/')
+    if not os.path.exists(build_path):
+        os.makedirs(build_path)
+    with open(file_path, 'w') as f:
+        f.write(data)
+    return file_path
 
-    # Determine MIME type of file
+
+def upload_file(client, file_path, bucket_name, object_key):
+    # Returns the number of bytes sent and the ETag of the uploaded object
     extension = os.path.splitext(file_path)[1]
-    if extension and extension in mime_types:
-        content_type = mime_types[extension]
-    else:
-        content_type = 'binary/octet-stream'
+    content_type = get_content_type(file_path)
+    cache_control = get_cache_control(object_key, content_type)
 
-    # Read file
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
+    # Large files are streamed; these are always compressed with zlib and have no brotli variant
+    if os.path.getsize(file_path) > multipart_threshold:
+        content_encoding = 'gzip' if extension in gzip_types else None
+        return _upload_file_multipart(client, file_path, bucket_name, object_key, 'public-read', content_type, cache_control, content_encoding)
 
-    # Compress file if necessary
+    # Read file, compressing if necessary
     content_encoding = None
     if extension in gzip_types:
-        output = io.BytesIO()
-        with gzip.GzipFile(fileobj=output, mode='wb') as f:
-            f.write(file_data)
-        file_data = output.getvalue()
-        content_encoding='gzip'
+        file_data = compress_file(file_path, 'gzip', gzip_levels.get(extension, 9))
+        content_encoding = 'gzip'
+    else:
+        with open(file_path, 'rb') as f:
+            file_data = f.read()
 
     # Upload file
-    _upload_file(client, file_data, bucket_name, object_key, 'public-read', content_type, 'public,max-age=31536000', content_encoding)
+    etag = _upload_file(client, file_data, bucket_name, object_key, 'public-read', content_type, cache_control, content_encoding)
+    total_bytes = len(file_data)
+
+    # Upload brotli variant
+    if has_brotli_variant(file_path):
+        file_data = compress_file(file_path, 'br', brotli_quality)
+        _upload_file(client, file_data, bucket_name, object_key + '.br', 'public-read', content_type, cache_control, 'br')
+        total_bytes += len(file_data)
+    return total_bytes, etag
+
+
+def get_content_type(file_path):
+    # Determine MIME type of file
+    extension = os.path.splitext(file_path)[1]
+    if extension and extension in mime_types:
+        return mime_types[extension]
+    return 'binary/octet-stream'
+
+
+def has_brotli_variant(file_path):
+    # Large files are streamed through multipart upload and are never given a brotli variant
+    return os.path.splitext(file_path)[1] in brotli_types and os.path.getsize(file_path) <= multipart_threshold
+
+
+def get_compression(file_path):
+    # Describes how a file is encoded when uploaded, e.g. 'gzip-9,br-11'. This is recorded in manifests so that files
+    # are uploaded again, rather than copied, when the compression settings for their type change.
+    extension = os.path.splitext(file_path)[1]
+    encodings = []
+    if extension in gzip_types:
+        encodings.append('gzip-{0}'.format(gzip_levels.get(extension, 9)))
+    if has_brotli_variant(file_path):
+        encodings.append('br-{0}'.format(brotli_quality))
+    return ','.join(encodings) or 'none'
+
+
+def get_cache_control(object_key, content_type):
+    for key_pattern, type_pattern, cache_control in cache_rules:
+        if key_pattern is not None and not fnmatch.fnmatchcase(object_key, key_pattern):
+            continue
+        if type_pattern is not None and not fnmatch.fnmatchcase(content_type, type_pattern):
+            continue
+        return cache_control
+    return cache_default
+
+
+def load_cache_config(cache):
+    # When present the cache element replaces the default rules
+    global cache_default
+    if cache is None:
+        return
+    cache_default = cache.get('default', cache_default)
+    del cache_rules[:]
+    for rule in cache.findall('rule'):
+        if rule.get('control') is None:
+            raise WebsiteError('Cache rule requires a control attribute')
+        cache_rules.append((rule.get('path'), rule.get('type'), rule.get('control')))
+
+
+def hashed_name(file_path, file_name):
+    # e.g. index.js becomes hashed/index.0123456789abcdef.js
+    base_name, extension = os.path.splitext(file_name)
+    return hashed_prefix + base_name + '.' + hash_file(file_path)[:16] + extension
+
+
+def upload_hashed_files(client, uploads, bucket_name, concurrency):
+    # Hashed objects are immutable so any that already exist are left untouched; returns the ETag of each object
+    etags = {}
+    missing_uploads = []
+    for file_path, object_key in uploads:
+        try:
+            etags[object_key] = client.head_object(Bucket=bucket_name, Key=object_key)['ETag']
+            print('{0:>12} {1:>8}  {2}'.format('unchanged', '', object_key))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            missing_uploads.append((file_path, object_key, None))
+    if missing_uploads:
+        etags.update(upload_files(client, missing_uploads, bucket_name, concurrency))
+    return etags
+
+
+def compress_data(file_data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(file_data, quality=level)
+    if level == 'zopfli':
+        return zopfli.gzip.compress(file_data)
+    return gzip.compress(file_data, compresslevel=int(level), mtime=0)     # fixed mtime keeps output reproducible
+
+
+def compress_file(file_path, encoding, level):
+    cache_file = os.path.join(compressed_cache_path, '{0}-{1}.{2}'.format(hash_file(file_path), level, encoding))
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            return f.read()
+    with profiler.stage('compress ' + encoding) as counts:
+        with open(file_path, 'rb') as f:
+            file_data = f.read()
+        counts['bytes_in'] = len(file_data)
+        file_data = compress_data(file_data, encoding, level)
+        counts['bytes_out'] = len(file_data)
+    if not os.path.exists(compressed_cache_path):
+        os.makedirs(compressed_cache_path, exist_ok=True)
+    # Write to a temporary name first so that concurrent uploads never read a partially written entry
+    temp_file = cache_file + '.' + str(threading.get_ident())
+    with open(temp_file, 'wb') as f:
+        f.write(file_data)
+    os.replace(temp_file, cache_file)
+    return file_data
+
+
+def content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('latin_1')
 
 
 def _upload_file(client, file_data, bucket_name, object_key, acl, content_type, cache_control, content_encoding):
+    # S3 rejects the upload if the received bytes do not match the MD5 digest; returns the object's ETag
+    args = {'Bucket': bucket_name, 'ACL': acl, 'CacheControl': cache_control, 'ContentType': content_type, 'Key': object_key}
     if content_encoding is not None:
-        response = client.put_object(
-            Bucket=bucket_name,
-            ACL=acl,
-            Body=file_data,
-            CacheControl=cache_control,
-            ContentEncoding=content_encoding,
-            ContentLength=len(file_data),
-            ContentType=content_type,
-            Key=object_key
-        )
-    else:
-        response = client.put_object(
-            Bucket=bucket_name,
-            ACL=acl,
-            Body=file_data,
-            CacheControl=cache_control,
-            ContentLength=len(file_data),
-            ContentType=content_type,
-            Key=object_key
-        )
+        args['ContentEncoding'] = content_encoding
+    response = client.put_object(Body=file_data, ContentLength=len(file_data), ContentMD5=content_md5(file_data), **args)
+    return response['ETag']
+
+
+def read_parts(file_path, part_size, level):
+    # Yields parts of exactly part_size bytes except the last, gzip compressing the file in chunks at the given level
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if level is not None else None     # wbits 31 selects gzip format
+    buffer = bytearray()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            buffer += compressor.compress(chunk) if compressor else chunk
+            while len(buffer) >= part_size:
+                yield bytes(buffer[:part_size])
+                del buffer[:part_size]
+    if compressor:
+        buffer += compressor.flush()
+    if buffer:
+        yield bytes(buffer)
+
+
+def _upload_file_multipart(client, file_path, bucket_name, object_key, acl, content_type, cache_control, content_encoding):
+    args = {'Bucket': bucket_name, 'ACL': acl, 'CacheControl': cache_control, 'ContentType': content_type, 'Key': object_key}
+    if content_encoding is not None:
+        args['ContentEncoding'] = content_encoding
+    upload_id = client.create_multipart_upload(**args)['UploadId']
+
+    # Compression runs on a producer thread so that it overlaps with the upload of the previous part; the queue is
+    # bounded so at most a few parts are held in memory at once
+    parts_queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def offer(item):
+        # Waits for space in the queue; returns False, leaving the item unqueued, once the consumer has stopped
+        while not stop.is_set():
+            try:
+                parts_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            level = gzip_levels.get(os.path.splitext(file_path)[1], 9)
+            level = 9 if level == 'zopfli' else int(level)
+            for part in read_parts(file_path, multipart_part_size, level if content_encoding == 'gzip' else None):
+                if not offer(part):
+                    return
+            offer(None)
+        except Exception as e:
+            offer(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    parts = []
+    total_bytes = 0
+    try:
+        while True:
+            part = parts_queue.get()
+            if part is None:
+                break
+            if isinstance(part, Exception):
+                raise part
+            response = client.upload_part(Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+                                          PartNumber=len(parts) + 1, Body=part, ContentMD5=content_md5(part))
+            parts.append({'ETag': response['ETag'], 'PartNumber': len(parts) + 1})
+            total_bytes += len(part)
+        response = client.complete_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+                                                    MultipartUpload={'Parts': parts})
+    except BaseException:
+        stop.set()
+        client.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+    return total_bytes, response['ETag']
+
+
+def import_boto3():
+    global boto3, Config, ClientError
+    try:
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+    except ImportError:
+        raise WebsiteError("Requires Boto3 module; try 'pip install boto3'")
+
+
+def create_client(region, concurrency=10, endpoint_url=None):
+    # Connection pool is sized to the worker pool so that concurrent uploads never wait on a free connection.
+    # Throttled and transient request failures are retried by botocore with backoff, and adaptive mode also limits
+    # the client's request rate once it is throttled.
+    if boto3 is None:
+        import_boto3()
+    config = Config(
+        region_name=region,
+        max_pool_connections=concurrency,
+        retries={'max_attempts': 5, 'mode': 'adaptive'}
+    )
+    return profiler.attach(boto3.client('s3', config=config, endpoint_url=endpoint_url))
+
+
+def copy_file(client, bucket_name, source_key, object_key, content_type, cache_control, content_encoding):
+    # Server side copy; the metadata is replaced, as for an upload, so that the copy takes the current cache rules
+    # rather than those in effect when the source was uploaded. Returns the ETag of the copy.
+    extra_args = {'ContentEncoding': content_encoding} if content_encoding else {}
+    response = client.copy_object(
+        Bucket=bucket_name,
+        ACL='public-read',
+        CopySource={'Bucket': bucket_name, 'Key': source_key},
+        MetadataDirective='REPLACE',
+        CacheControl=cache_control,
+        ContentType=content_type,
+        Key=object_key,
+        **extra_args
+    )
+    return response['CopyObjectResult']['ETag']
+
+
+def upload_files(client, uploads, bucket_name, concurrency, journal=None):
+    # Upload a list of (file_path, object_key, source_key) entries through a bounded worker pool. Where a source key
+    # is given the file is unchanged from a previous version and the object is copied server side instead. Objects
+    # recorded in the journal as already uploaded from the same content are skipped, and each completed object is
+    # added to it. Returns the ETag of each object.
+    start_time = time.perf_counter()
+    total_bytes = 0
+    copy_count = 0
+    resume_count = 0
+    etags = {}
+
+    def upload(file_path, object_key, source_key):
+        file_start_time = time.perf_counter()
+        sha256 = hash_file(file_path) if journal else None
+        etag = journal.lookup(object_key, sha256) if journal else None
+        if etag is not None:
+            return 'resumed', etag, 0.0
+        if source_key is not None:
+            try:
+                with profiler.stage('copy file'):
+                    content_type = get_content_type(file_path)
+                    cache_control = get_cache_control(object_key, content_type)
+                    content_encoding = 'gzip' if os.path.splitext(file_path)[1] in gzip_types else None
+                    copy_etag = copy_file(client, bucket_name, source_key, object_key, content_type, cache_control, content_encoding)
+                    if has_brotli_variant(file_path):
+                        copy_file(client, bucket_name, source_key + '.br', object_key + '.br', content_type, cache_control, 'br')
+                size, etag = 'copied', copy_etag
+            except ClientError as e:
+                # Source version (or its brotli variant) may be missing, e.g. deleted since its manifest was written;
+                # fall back to uploading
+                if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+                    raise
+        if etag is None:
+            with profiler.stage('upload file') as counts:
+                size, etag = upload_file(client, file_path, bucket_name, object_key)
+                counts['bytes_in'] = os.path.getsize(file_path)
+                counts['bytes_out'] = size
+        if journal:
+            journal.record(object_key, sha256, etag)
+        return size, etag, time.perf_counter() - file_start_time
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload, *entry): entry[1] for entry in uploads}
+        for future in as_completed(futures):
+            object_key = futures[future]
+            try:
+                size, etags[object_key], elapsed = future.result()
+            except ClientError as e:
+                for pending in futures:
+                    pending.cancel()
+                raise WebsiteError('Failed to upload ' + object_key + ': ' + str(e))
+            if size == 'copied':
+                copy_count += 1
+            elif size == 'resumed':
+                resume_count += 1
+            else:
+                total_bytes += size
+            print('{0:>12}  {1:7.2f}s  {2}'.format(size if isinstance(size, str) else '{0:,}'.format(size), elapsed, object_key))
+
+    # Display throughput summary
+    elapsed = time.perf_counter() - start_time
+    rate = total_bytes / elapsed / 1048576 if elapsed > 0 else 0.0
+    resumed = ', {0} already uploaded'.format(resume_count) if resume_count else ''
+    print('Uploaded {0} files ({1} unchanged{2}), {3:,} bytes in {4:.2f}s ({5:.2f} MB/s)'.format(
+        len(uploads), copy_count, resumed, total_bytes, elapsed, rate))
+    return etags
+
+
+def run_stages(stages):
+    # Runs a list of (name, function, dependencies) stages concurrently; each stage starts as soon as all of the
+    # stages it depends on have completed. A failing stage stops any further stages from starting.
+    completed = set()
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for stage in [s for s in pending if all(d in completed for d in s[2])]:
+                pending.remove(stage)
+                running[executor.submit(stage[1])] = stage[0]
+            if not running:
+                raise RuntimeError('Stage dependencies cannot be met: ' + ', '.join(s[0] for s in pending))
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+                completed.add(name)
+
+
+def load_hash_cache():
+    # Only read once, so that entries added since are kept
+    if not hash_cache and os.path.exists(hash_cache_file):
+        with open(hash_cache_file, 'r') as f:
+            hash_cache.update(json.load(f))
+
+
+def save_hash_cache():
+    # Entries for files that no longer exist are dropped
+    entries = {k: v for k, v in hash_cache.items() if os.path.exists(k)}
+    if not os.path.exists(os.path.dirname(hash_cache_file)):
+        os.makedirs(os.path.dirname(hash_cache_file))
+    with open(hash_cache_file, 'w') as f:
+        json.dump(entries, f)
+
+
+def hash_file(file_path):
+    # File hashes are cached against size and modification time so that unchanged files are not re-read
+    stat = os.stat(file_path)
+    cached = hash_cache.get(file_path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha.update(chunk)
+    hash_cache[file_path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def build_manifest(uploads, object_prefix):
+    # A manifest maps each object name within a version to the hash and size of its source file and the compression
+    # applied to it; the ETag of each object is added once it has been uploaded
+    files = {}
+    for file_path, object_key in uploads:
+        files[object_key[len(object_prefix):]] = {
+            'sha256': hash_file(file_path), 'size': os.path.getsize(file_path), 'compression': get_compression(file_path)}
+    return {'files': files}
+
+
+def upload_manifest(client, bucket_name, version_id, manifest):
+    manifest_data = json.dumps(manifest, indent=1).encode('utf-8')
+    _upload_file(client, manifest_data, bucket_name, 'manifest-' + version_id + '.json', 'private', mime_types['.json'], 'no-cache', None)
+
+
+def get_latest_manifest(client, bucket_name):
+    # Find the most recently pushed version that has a manifest
+    latest = None
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='manifest-'):
+        for entry in page.get('Contents', []):
+            if latest is None or entry['LastModified'] > latest['LastModified']:
+                latest = entry
+    if latest is None:
+        return None, None
+    response = client.get_object(Bucket=bucket_name, Key=latest['Key'])
+    version_id = latest['Key'][9:-5]
+    return version_id, json.loads(response['Body'].read().decode('utf-8'))
+
+
+def plan_incremental_upload(uploads, object_prefix, manifest, previous_version_id, previous_manifest):
+    # Files whose content hash and compression match the previous version are copied from that version rather than
+    # uploaded
+    planned = []
+    previous_files = previous_manifest['files'] if previous_manifest else {}
+    for file_path, object_key in uploads:
+        name = object_key[len(object_prefix):]
+        previous = previous_files.get(name)
+        current = manifest['files'][name]
+        if previous and previous['sha256'] == current['sha256'] and previous.get('compression') == current['compression']:
+            planned.append((file_path, object_key, previous_version_id + '/' + name))
+        else:
+            planned.append((file_path, object_key, None))
+    return planned
+
+
+def verify_version(client, bucket_name, version_id, concurrency):
+    # Checks that each object listed in the version manifest exists with the recorded ETag; returns a list of problems
+    try:
+        response = client.get_object(Bucket=bucket_name, Key='manifest-' + version_id + '.json')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise WebsiteError('Version ' + version_id + ' has no manifest')
+        raise
+    manifest = json.loads(response['Body'].read().decode('utf-8'))
+    objects = {version_id + '/' + name: entry for name, entry in manifest['files'].items()}
+    objects.update(manifest.get('hashed', {}))
+    objects['index-' + version_id + '.html'] = {}
+
+    def check(object_key, entry):
+        try:
+            response = client.head_object(Bucket=bucket_name, Key=object_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return object_key + ' is missing'
+            raise
+        if 'etag' in entry and response['ETag'] != entry['etag']:
+            return '{0} has ETag {1}, expected {2}'.format(object_key, response['ETag'], entry['etag'])
+        if 'size' in entry and 'ContentEncoding' not in response and response['ContentLength'] != entry['size']:
+            return '{0} is {1:,} bytes, expected {2:,}'.format(object_key, response['ContentLength'], entry['size'])
+        return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        problems = [p for p in executor.map(lambda item: check(*item), sorted(objects.items())) if p]
+    print('Verified {0} objects, {1} problems'.format(len(objects), len(problems)))
+    return problems
+
+
+def deploy_version(client, bucket_name, version_id):
+    # Server side copy of the version index file to index.html, replacing its metadata to shorten the cache lifetime
+    # and record the version id. The copy replaces index.html atomically so no partial state is ever served.
+    source_key = 'index-' + version_id + '.html'
+    try:
+        response = client.head_object(Bucket=bucket_name, Key=source_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise WebsiteError('Version ' + version_id + ' does not exist')
+        raise
+    extra_args = {'ContentEncoding': response['ContentEncoding']} if 'ContentEncoding' in response else {}
+    client.copy_object(
+        Bucket=bucket_name,
+        ACL='public-read',
+        CopySource={'Bucket': bucket_name, 'Key': source_key},
+        MetadataDirective='REPLACE',
+        CacheControl=get_cache_control('index.html', response['ContentType']),
+        ContentType=response['ContentType'],
+        Metadata={'version-id': version_id},
+        Key='index.html',
+        **extra_args
+    )
 
 
 def get_live_version_id(client, bucket_name):
+    # Deployed index.html records its version id as object metadata
+    try:
+        response = client.head_object(Bucket=bucket_name, Key='index.html')
+    except ClientError:
+        return None
+    if 'version-id' in response.get('Metadata', {}):
+        return response['Metadata']['version-id']
+
+    # Fall back to scanning index.html deployed before the version id was recorded
     flo = io.BytesIO()
     try:
         client.download_fileobj(bucket_name, 'index.html', flo)
@@ -342,155 +1121,486 @@ def get_live_version_id(client, bucket_name):
     return live_version_id
 
 
-if __name__ == '__main__':
-
-    if len(sys.argv) < 2:
-        sys.exit(PURPOSE)
+def load_compression_config(compression):
+    # When present the compression element replaces the default gzip_types
+    if compression is None:
+        return
+    del gzip_types[:]
+    for entry in compression.findall('type'):
+        extension = entry.get('extension')
+        level = entry.get('gzip', '9')
+        if level != 'none':
+            gzip_types.append(extension)
+            gzip_levels[extension] = level if level == 'zopfli' else int(level)
+        if entry.get('brotli', 'false') == 'true':
+            brotli_types.append(extension)
+    if brotli_types and brotli is None:
+        raise WebsiteError("Brotli compression requires Brotli module; try 'pip install brotli'")
+    if 'zopfli' in gzip_levels.values() and zopfli is None:
+        raise WebsiteError("Zopfli compression requires zopfli module; try 'pip install zopfli'")
+
+
+def get_version_description(client, bucket_name, version_id):
+    response = client.get_object_tagging(Bucket=bucket_name, Key='index-' + version_id + '.html')
+    for tag in response['TagSet']:
+        if tag['Key'] == 'description':
+            return tag['Value']
+    return ''
+
+
+def get_version_size(client, bucket_name, version_id):
+    size = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=version_id + '/'):
+        for entry in page.get('Contents', []):
+            size += entry['Size']
+    return size
+
+
+def list_index_entries(client, bucket_name):
+    # Returns the listing entry of each version's index file keyed by version id
+    index_entries = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='index-'):
+        for entry in page.get('Contents', []):
+            index_entries[entry['Key'][6:-5]] = entry
+    return index_entries
+
+
+def list_versions(client, bucket_name, concurrency, cache_file=None, refresh=False):
+    # Returns (version_id, metadata) pairs ordered by push time. Metadata for versions already in the cache file is
+    # reused, so only versions pushed since the last listing cost additional requests. With refresh set the cache is
+    # not read, but is still rewritten with the metadata fetched.
+    cache = {}
+    if cache_file and not refresh and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+
+    # Fetch description and size of new versions concurrently
+    versions = {}
+    new_versions = []
+    for version_id, entry in list_index_entries(client, bucket_name).items():
+        pushed = entry['LastModified'].isoformat()
+        if version_id in cache and cache[version_id]['pushed'] == pushed:
+            versions[version_id] = cache[version_id]
+        else:
+            new_versions.append(version_id)
+            versions[version_id] = {'pushed': pushed}
+
+    def fetch(version_id):
+        return get_version_description(client, bucket_name, version_id), get_version_size(client, bucket_name, version_id)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for version_id, (description, size) in zip(new_versions, executor.map(fetch, new_versions)):
+            versions[version_id]['description'] = description
+            versions[version_id]['size'] = size
+
+    # Versions deleted since the last listing are dropped from the cache
+    if cache_file:
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as f:
+            json.dump(versions, f, indent=1)
+    return sorted(versions.items(), key=lambda item: item[1]['pushed'])
+
+
+def delete_version(client, bucket_name, version_id):
+    # Objects are deleted in batches as they are listed; delete_objects accepts at most 1000 keys per request. The index
+    # and manifest are only deleted where they exist since an interrupted push may have written neither. Returns the
+    # number of objects deleted, or None where the version does not exist.
+    delete_keys = []
+    for object_key in ['index-' + version_id + '.html', 'manifest-' + version_id + '.json']:
+        try:
+            client.head_object(Bucket=bucket_name, Key=object_key)
+            delete_keys.append({'Key': object_key})
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+    deleted_count = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=version_id + '/'):
+        for entry in page.get('Contents', []):
+            delete_keys.append({'Key': entry['Key']})
+        while len(delete_keys) >= 1000:
+            deleted_count += _delete_objects(client, bucket_name, delete_keys[:1000])
+            del delete_keys[:1000]
+    if delete_keys:
+        deleted_count += _delete_objects(client, bucket_name, delete_keys)
+    return deleted_count if deleted_count else None
+
+
+def _delete_objects(client, bucket_name, delete_keys):
+    response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': delete_keys, 'Quiet': True})
+    if response.get('Errors'):
+        error = response['Errors'][0]
+        raise RuntimeError('Failed to delete ' + error['Key'] + ': ' + error['Message'])
+    return len(delete_keys)
+
+
+def delete_versions(client, bucket_name, version_ids, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(delete_version, client, bucket_name, version_id): version_id for version_id in version_ids}
+        for future in as_completed(futures):
+            version_id = futures[future]
+            try:
+                deleted_count = future.result()
+                if deleted_count is None:
+                    print('Version ' + version_id + ' does not exist')
+                else:
+                    print('Deleted version {0} ({1} objects)'.format(version_id, deleted_count))
+            except (ClientError, RuntimeError) as e:
+                print('Failed to delete version ' + version_id + ': ' + str(e))
+
+
+def delete_unreferenced_hashed_files(client, bucket_name, concurrency, min_age=datetime.timedelta(days=1)):
+    # Hashed code files are shared between versions so they are not deleted with a version; those that no remaining
+    # manifest references are deleted here. Recently uploaded files are kept since a push in progress uploads them
+    # before its manifest is written. Returns the number of objects deleted.
+    manifest_keys = []
+    hashed_entries = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='manifest-'):
+        manifest_keys.extend(entry['Key'] for entry in page.get('Contents', []))
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=hashed_prefix):
+        hashed_entries.extend(page.get('Contents', []))
+    if not hashed_entries:
+        return 0
+
+    def fetch(manifest_key):
+        response = client.get_object(Bucket=bucket_name, Key=manifest_key)
+        return json.loads(response['Body'].read().decode('utf-8')).get('hashed', {})
+
+    referenced = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for hashed in executor.map(fetch, manifest_keys):
+            referenced.update(hashed)
+
+    # Brotli variants are kept and deleted along with the file they are compressed from
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - min_age
+    delete_keys = []
+    for entry in hashed_entries:
+        object_key = entry['Key'][:-3] if entry['Key'].endswith('.br') else entry['Key']
+        if object_key not in referenced and entry['LastModified'] < cutoff:
+            delete_keys.append({'Key': entry['Key']})
+    deleted_count = 0
+    for index in range(0, len(delete_keys), 1000):
+        deleted_count += _delete_objects(client, bucket_name, delete_keys[index:index + 1000])
+    return deleted_count
+
+
+def select_prune_versions(index_entries, live_version_id, keep=None, older_than=None):
+    # Versions are ordered newest first by their timemark. A version is pruned if it falls outside the newest 'keep'
+    # versions and, when given, is older than 'older_than'. The live version is never pruned.
+    dated_versions = []
+    for version_id in index_entries:
+        try:
+            dated_versions.append((decode_timemark(version_id), version_id))
+        except (ValueError, IndexError):
+            print('Skipping ' + version_id + '; version id does not begin with a timemark')
+    dated_versions.sort(reverse=True)
 
-    config = ET.parse('configuration.xml').getroot().find('website')
+    now = datetime.datetime.utcnow()
+    prune_versions = []
+    for index, (pushed, version_id) in enumerate(dated_versions):
+        if version_id == live_version_id:
+            continue
+        if keep is not None and index < keep:
+            continue
+        if older_than is not None and now - pushed < older_than:
+            continue
+        prune_versions.append(version_id)
+    return prune_versions
+
+
+def serve(port=8000):
+    # Serves the website directory as production would with respect to content types and compression. Pages reload
+    # when a file changes, after index.html is rebuilt; compiled.html loads the output of a separate watch command.
+    import dev_server
+    dev_server.serve(
+        website_path, mime_types, gzip_types, gzip_levels,
+        aliases={'/.cache/compiled.js': cache_path + '/compiled.js'},
+        snapshot=lambda: snapshot_files([website_path]),
+        on_change=reindex_html,
+        port=port)
+
+
+def jshint_config(file_path, parsed, declared_in, options):
+    # Names the file uses that are declared in other files are globals to jshint, as they are once files are combined;
+    # each configuration is written once and named by its content. Globals defined in .jshintrc are kept.
+    names = sorted(n for n in parsed[file_path]['references'] if declared_in.get(n, file_path) != file_path)
+    generated = {n: False for n in names}
+    config_data = json.dumps(dict(options, globals=dict(options.get('globals', {}), **generated)), sort_keys=True)
+    config_file = os.path.join(lint_path, 'jshintrc-' + hashlib.sha256(config_data.encode('utf-8')).hexdigest()[:16] + '.json')
+    if not os.path.exists(config_file):
+        with open(config_file, 'w') as f:
+            f.write(config_data)
+    return config_file.replace('\\', '/'), config_data
+
+
+def run_linter(command, exit_codes, file_path):
+    # Returns the linter's messages with the file path removed so that they can be cached by file content. Raises
+    # CalledProcessError where the linter fails, i.e. exits with a code other than those expected or writes output
+    # that is neither a message nor jshint's summary line.
+    result = subprocess.run(command + [file_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    lines = [line for line in result.stdout.splitlines() if line.strip()]
+    messages = [line[len(file_path):] for line in lines if line.startswith(file_path)]
+    unparsed = [line for line in lines if not line.startswith(file_path) and not lint_summary_pattern.match(line)]
+    if result.returncode not in exit_codes or unparsed:
+        raise subprocess.CalledProcessError(result.returncode, command, result.stdout)
+    return messages
+
+
+def lint():
+    # Each file is linted separately, in parallel, so that reported line numbers refer to the source file; only files
+    # that have changed since they were last linted (or whose options have changed) are passed to the linters
+    cache = {}
+    if os.path.exists(lint_cache_file):
+        with open(lint_cache_file, 'r') as f:
+            cache = json.load(f)
+    if not os.path.exists(lint_path):
+        os.makedirs(lint_path)
+
+    jobs = []
+    js_files = list_files(website_path + '/source', extensions=['.js'])
+    extern_files = list_files(website_path + '/externs', extensions=['.js'])
+    parsed = parse_js_files(js_files + extern_files, cache_path + '/dependency_graph.json')
+    declared_in = {}
+    for file_path in js_files + extern_files:
+        for name in parsed[file_path]['declarations']:
+            declared_in.setdefault(name, file_path)
+    with open(root_path + '/.jshintrc', 'r') as f:
+        jshint_options = json.load(f)
+    jshint = 'jshint.cmd' if sys.platform == 'win32' else 'jshint'
+    for file_path in js_files:
+        config_file, config_data = jshint_config(file_path, parsed, declared_in, jshint_options)
+        jobs.append((file_path, [jshint, '--reporter=unix', '--config', config_file], jshint_exit_codes, 'jshint ' + config_data))
+    csslint = 'csslint.cmd' if sys.platform == 'win32' else 'csslint'
+    for file_path in list_files(website_path + '/source', extensions=['.css']):
+        jobs.append((file_path, [csslint] + csslint_options, csslint_exit_codes, 'csslint ' + ' '.join(csslint_options)))
+
+    results = {}
+    pending = {}
+    failures = {}
+    jobs = [(f, c, e, hashlib.sha256((o + hash_file(f)).encode('utf-8')).hexdigest()) for f, c, e, o in jobs]
+    for file_path, command, exit_codes, key in jobs:
+        if key in cache:
+            results[key] = cache[key]
+        else:
+            pending[key] = (file_path, command, exit_codes)
+
+    with profiler.stage('lint'):
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(run_linter, command, exit_codes, file_path): key
+                       for key, (file_path, command, exit_codes) in pending.items()}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except subprocess.CalledProcessError as e:
+                    failures[futures[future]] = e
+                except OSError:
+                    command = pending[futures[future]][1][0]
+                    if command.startswith('jshint'):
+                        raise WebsiteError("JSHint not installed; try 'npm install -g jshint'")
+                    raise WebsiteError("CSSLint not installed; try 'npm install -g csslint'")
+
+    # Results are saved for the current files only so that the cache does not grow without limit; failed runs are
+    # not saved so that those files are linted again next time
+    with open(lint_cache_file, 'w') as f:
+        json.dump(results, f)
+
+    message_count = 0
+    for file_path, command, exit_codes, key in jobs:
+        for message in results.get(key, []):
+            print(file_path + message)
+            message_count += 1
+    print('Linted {0} files ({1} unchanged), {2} problems'.format(len(jobs), len(jobs) - len(pending), message_count))
+    if failures:
+        for key, e in failures.items():
+            print('{0} failed on {1} with exit code {2}:\n{3}'.format(
+                os.path.basename(e.cmd[0]), pending[key][0], e.returncode, e.output.rstrip()))
+        raise WebsiteError('Linting failed for {0} files'.format(len(failures)))
+
+
+def configure(file_name=script_path + '/configuration.xml'):
+    global region, bucket_name, closure_version, upload_concurrency, endpoint_url, minifier, hashed_names_enabled
+    global image_optimize_enabled, image_webp, pack_enabled, pack_options
+    config = ET.parse(file_name).getroot().find('website')
     region = config.find('region').text
     bucket_name = config.find('bucket').text
     closure_version = config.find('closure_version').text
-
-    command = sys.argv[1]
-    if command == 'list':
-        client = boto3.client('s3', config=Config(region_name=region))
-
-        # Get version id of currently live version
-        live_version_id = get_live_version_id(client, bucket_name)
-
-        # List all index files on site
-        response = client.list_objects_v2(
-            Bucket=bucket_name,
-            Prefix='index-'
-        )
-        if 'Contents' in response:
-            for entry in response['Contents']:
-                key = entry['Key']
-                version_id = key[6:-5]
-                current = '*' if version_id == live_version_id else ''
-                tags_response = client.get_object_tagging(
-                    Bucket=bucket_name,
-                    Key=key
-                )
-                description = ''
-                for tag in tags_response['TagSet']:
-                    if tag['Key'] == 'description':
-                        description = tag['Value']
-                        break
-                print("{0} {1:1}  {2}".format(version_id, current, description))
-
-    elif command == 'reindex':
-        js_files = list_files('../website/source', extensions=['.js'])
-        js_files = sort_js_by_class_hierarchy(js_files)
-        js_files = ['/'.join(f.split('/')[2:]) for f in js_files]   # make paths relative to index.html
-        css_files = list_files('../website/source', extensions=['.css'])
-        css_files = ['/'.join(f.split('/')[2:]) for f in css_files]   # make paths relative to index.html
-        populated_data = populate_html('../website/index.html', js_files, css_files)
-        with open('../website/index.html', 'w') as f:
-            f.write(populated_data)
-
-        js_files = ['../.cache/compiled.js']
-        populated_data = populate_html('../website/index.html', js_files, css_files)
-        with open('../website/compiled.html', 'w') as f:
-            f.write(populated_data)
-
-    elif command == 'compile':
-        compile_javascript(closure_version)
-
-    elif command == 'lint':
-        js_files = list_files('../website/source', extensions=['.js'])
-        js_files = sort_js_by_class_hierarchy(js_files)
-        combined_file = '../.cache/combined.js'
-        combined_path = os.path.dirname(combined_file)
-        if not os.path.exists(combined_path):
-            os.makedirs(combined_path)
-        with open(combined_file, 'w') as w:
-            for input_file in js_files:
-                with open(input_file, 'r') as r:
-                    w.write(r.read() + '\n')
-        try:
-            subprocess.call(['jshint.cmd' if sys.platform == 'win32' else 'jshint', combined_file])
-        except OSError as e:
-            sys.exit("JSHint not installed; try 'npm install -g jshint'")
-
-        css_files = list_files('../website/source', extensions=['.css'])
-        combined_file = '../.cache/combined.css'
-        with open(combined_file, 'w') as w:
-            for input_file in css_files:
-                with open(input_file, 'r') as r:
-                    w.write(r.read() + '\n')
-        try:
-            subprocess.call(
-                [
-                    'csslint.cmd' if sys.platform == 'win32' else 'csslint',
-                    '--quiet',
-                    '--format=compact',
-                    '--ignore=order-alphabetical,fallback-colors,compatible-vendor-prefixes,font-sizes',
-                    combined_file
-                ]
-            )
-        except OSError:
-            sys.exit("CSSLint not installed; try 'npm install -g csslint'")
-
-    elif command == 'push':
-        if len(sys.argv) < 3:
-            sys.exit(PURPOSE)
-
-        description = " ".join(sys.argv[2:])
+    upload_concurrency = int(config.findtext('upload_concurrency', '10'))
+    endpoint_url = config.findtext('endpoint_url') or None     # e.g. a local S3 stand-in such as moto_server
+    minifier = config.findtext('minifier', minifier)
+    load_compression_config(config.find('compression'))
+    load_cache_config(config.find('cache'))
+    hashed_names = config.find('hashed_names')
+    if hashed_names is not None:
+        hashed_names_enabled = hashed_names.get('enabled', 'false') == 'true'
+    images = config.find('images')
+    if images is not None:
+        image_optimize_enabled = images.get('optimize', 'false') == 'true'
+        image_webp = images.get('webp', 'false') == 'true'
+    pack = config.find('pack')
+    if pack is not None:
+        pack_enabled = pack.get('enabled', 'false') == 'true'
+        pack_options = {k: int(v) for k, v in pack.attrib.items() if k != 'enabled'}
+
+
+def build_css():
+    # Combine and minify CSS
+    css_files = list_files(website_path + '/source', extensions=[".css"])
+    css_data = []
+    for css_file in css_files:
+        with open(css_file, 'r') as r:
+            css_path = site_path(css_file)
+            css_data.append(rebase_css_urls(r.read(), css_path) + '\n')
+    return write_build_file('index.css', minify_css_data(''.join(css_data)))
+
+
+def build():
+    # Compiles javascript and builds CSS without uploading; returns the built index.js and index.css file paths
+    load_hash_cache()
+    results = {}
+
+    def compile_stage():
+        with profiler.stage('compile javascript'):
+            results['index.js'] = compile_javascript(closure_version)
+
+    def css_stage():
+        results['index.css'] = build_css()
+
+    run_stages([('compile', compile_stage, []), ('css', css_stage, [])])
+    save_hash_cache()
+    return results
+
+
+def push(description, resume=False):
+    # Uploads a new site version and returns its version id; the version is not live until deployed. Completed
+    # uploads are journaled so that when resume is set an interrupted push continues under its original version id.
+    load_hash_cache()
+    journal = PushJournal(journal_file.format(bucket_name))
+    interrupted = journal.load()
+    if resume:
+        if interrupted is None:
+            raise WebsiteError('No interrupted push to resume')
+        version_id, description = interrupted
+        print('Resuming push of version ' + version_id)
+    else:
+        if interrupted is not None:
+            print('Discarding interrupted push of version {0}; its objects may be removed with delete'.format(interrupted[0]))
+            journal.completed.clear()
         version_id = encode_timemark() + '-' + base64.b32encode(os.urandom(10)).decode('latin_1')
-        object_prefix = version_id + '/'
-
-        # Compile javascript
-        compiled_file = compile_javascript(closure_version)
-
-        # Upload compiled javascript as index.js
-        client = boto3.client('s3', config=Config(region_name=region))
-        upload_file(client, compiled_file, bucket_name, object_prefix + 'index.js')
-
-        # Combine, minify and upload CSS as index.css
-        css_files = list_files('../website/source', extensions=[".css"])
-        combined_file = tempfile.mktemp() + ".css"
-        with open(combined_file, 'w') as w:
-            for css_file in css_files:
-                with open(css_file, 'r') as r:
-                    w.write(r.read() + '\n')
-        minified_file = tempfile.mktemp() + '.css'
-        minify_css(combined_file, minified_file)
-        upload_file(client, minified_file, bucket_name, object_prefix + 'index.css')
-
+    journal.start(version_id, description)
+    object_prefix = version_id + '/'
+
+    client = create_client(region, upload_concurrency, endpoint_url)
+    index_file_name = 'index-' + version_id + '.html'
+    results = {}
+
+    def compile_stage():
+        with profiler.stage('compile javascript'):
+            results['compiled_file'] = compile_javascript(closure_version)
+
+    def css_stage():
+        results['css_file'] = build_css()
+
+    def previous_manifest_stage():
+        results['previous'] = get_latest_manifest(client, bucket_name)
+
+    def incremental_upload(uploads):
+        # Unchanged files are copied from the previous version rather than uploaded again
+        with profiler.stage('hash files'):
+            manifest = build_manifest(uploads, object_prefix)
+        previous_version_id, previous_manifest = results['previous']
+        uploads = plan_incremental_upload(uploads, object_prefix, manifest, previous_version_id, previous_manifest)
+        with profiler.stage('upload files'):
+            etags = upload_files(client, uploads, bucket_name, upload_concurrency, journal)
+        for object_key, etag in etags.items():
+            manifest['files'][object_key[len(object_prefix):]]['etag'] = etag
+        return manifest
+
+    def asset_stage():
         # Upload top level files
-        top_level_files = ['../website/favicon.ico']
+        uploads = []
+        top_level_files = [website_path + '/favicon.ico']
         for file_name in top_level_files:
-            key_name = object_prefix + '/'.join(file_name.split('/')[2:])
-            upload_file(client, file_name, bucket_name, key_name)
+            key_name = object_prefix + site_path(file_name)
+            uploads.append((file_name, key_name))
 
         # Upload asset files
-        file_list = list_files('../website/assets')
+        file_list = list_files(website_path + '/assets')
         for file_name in file_list:
-            key_name = object_prefix + '/'.join(file_name.split('/')[2:])
-            upload_file(client, file_name, bucket_name, key_name)
+            key_name = object_prefix + site_path(file_name)
+            uploads.append((file_name, key_name))
+
+        # Optimized images replace the originals; WebP variants are uploaded alongside
+        if image_optimize_enabled:
+            image_uploads = [u for u in uploads if os.path.splitext(u[0])[1].lower() in image_types]
+            optimized_files = optimize_images([u[0] for u in image_uploads], image_webp)
+            for upload in image_uploads:
+                optimized_file, webp_file = optimized_files[upload[0]]
+                uploads[uploads.index(upload)] = (optimized_file, upload[1])
+                if webp_file:
+                    uploads.append((webp_file, os.path.splitext(upload[1])[0] + '.webp'))
+
+        # Upload packed assets alongside the originals, which remain available to load individually
+        if pack_enabled:
+            for file_name in pack_website_assets():
+                uploads.append((file_name, object_prefix + 'assets/packed/' + os.path.basename(file_name)))
 
         # Upload minified libraries
-        library_files = list_files('../website/libraries')
+        library_files = list_files(website_path + '/libraries')
         for file_name in library_files:
             if file_name.find('.min.') != -1:
-                key_name = object_prefix + '/'.join(file_name.split('/')[2:])
-                upload_file(client, file_name, bucket_name, key_name)
-
-        # Finalize and upload index.html
-        populated_data = populate_html('../website/index.html', ['index.js'], ['index.css'])
-        replacements = [('normalize.css', 'normalize.min.css')]
-        for replacement in replacements:
-            populated_data = populated_data.replace(replacement[0], replacement[1])
-        baked_data = bake_html_version(populated_data, version_id)
-        tf = tempfile.mktemp() + '.html'
-        with open (tf, 'w') as f:
-            f.write(baked_data)
-        minify_html(tf, tf)
-        index_file_name = 'index-' + version_id + '.html'
-        upload_file(client, tf, bucket_name, index_file_name)
-        os.remove(tf)
+                key_name = object_prefix + site_path(file_name)
+                uploads.append((file_name, key_name))
+        results['asset_manifest'] = incremental_upload(uploads)
+
+    def hashed_files():
+        # index.css is only given a hashed name when it has no relative url() references, since these must
+        # resolve from the version path
+        if not hashed_names_enabled:
+            return {}
+        files = {'index.js': results['compiled_file']}
+        with open(results['css_file'], 'r') as f:
+            css_paths = [m.group(2).strip() for m in css_url_pattern.finditer(f.read())]
+        if not any(is_relative_path(path) for path in css_paths):
+            files['index.css'] = results['css_file']
+        return files
+
+    def code_stage():
+        # Upload compiled javascript as index.js and minified CSS as index.css
+        code_files = {'index.js': results['compiled_file'], 'index.css': results['css_file']}
+        hashed = hashed_files()
+        results['hashed'] = {}
+        if hashed:
+            uploads = [(file_path, hashed_name(file_path, name)) for name, file_path in hashed.items()]
+            with profiler.stage('upload files'):
+                etags = upload_hashed_files(client, uploads, bucket_name, upload_concurrency)
+            for file_path, object_key in uploads:
+                results['hashed'][object_key] = {'sha256': hash_file(file_path), 'size': os.path.getsize(file_path), 'etag': etags[object_key]}
+        uploads = [(file_path, object_prefix + name) for name, file_path in code_files.items() if name not in hashed]
+        results['code_manifest'] = incremental_upload(uploads) if uploads else {'files': {}}
+
+    def html_stage():
+        with profiler.stage('build html'):
+            populated_data = populate_html(website_path + '/index.html', ['index.js'], ['index.css'])
+            path_map = {'libraries/normalize.css': 'libraries/normalize.min.css'}
+            unversioned_paths = []
+            for name, file_path in hashed_files().items():
+                path_map[name] = hashed_name(file_path, name)
+                unversioned_paths.append(path_map[name])
+            baked_data = bake_html_version(populated_data, version_id, path_map, unversioned_paths, pack_enabled)
+        results['html_file'] = write_build_file('index.html', minify_html_data(baked_data))
+
+    def index_stage():
+        # The version manifest and index file are written last; the version is not visible until its index exists
+        manifest = results['asset_manifest']
+        manifest['files'].update(results['code_manifest']['files'])
+        if results['hashed']:
+            manifest['hashed'] = results['hashed']
+        upload_manifest(client, bucket_name, version_id, manifest)
+        upload_file(client, results['html_file'], bucket_name, index_file_name)
 
         # Add description tag to index file
         response = client.put_object_tagging(
@@ -498,55 +1608,164 @@ if __name__ == '__main__':
             Key=index_file_name,
             Tagging={'TagSet': [{'Key': 'description', 'Value': description}]}
         )
+        journal.finish()
 
-        # Display link to version
-        print('Version available at https://' + bucket_name + '.s3.amazonaws.com/index-' + version_id + '.html')
+    run_stages([
+        ('compile', compile_stage, []),
+        ('css', css_stage, []),
+        ('previous manifest', previous_manifest_stage, []),
+        ('assets', asset_stage, ['previous manifest']),
+        ('code', code_stage, ['compile', 'css', 'previous manifest']),
+        ('html', html_stage, ['compile', 'css'] if hashed_names_enabled else []),
+        ('index', index_stage, ['assets', 'code', 'html'])
+    ])
 
-    elif command == 'deploy':
-        # Copy version index file to index.html
-        version_id = sys.argv[2] if len(sys.argv) > 2 else sys.exit(PURPOSE)
-        client = boto3.client('s3', config=Config(region_name=region))
-        response = client.get_object(
-            Bucket=bucket_name,
-            Key='index-' + version_id + '.html'
-        )
-        content_type = response['ContentType']
-        content_encoding = response['ContentEncoding'] if 'ContentEncoding' in response else None
-        file_data = response['Body'].read()
-        _upload_file(client, file_data, bucket_name, 'index.html', 'public-read', content_type, 'public,max-age=300', content_encoding)
-        print('Deployed version ' + version_id)
-
-    elif command == 'delete':
-        client = boto3.client('s3', config=Config(region_name=region))
-
-        # Get version id of current live version
-        live_version_id = get_live_version_id(client, bucket_name)
-
-        # Delete each specified version
-        for version_key in sys.argv[2:]:
-            if version_key == live_version_id:
-                print(live_version_id + 'is live and will not be deleted')
-                continue
-
-            # List all objects to be deleted
-            response = client.list_objects_v2(
-                Bucket=bucket_name,
-                Prefix=version_key
-            )
-            delete_keys = []
-            for entry in response['Contents']:
-                delete_keys.append({'Key': entry['Key']})
-            delete_keys.append({'Key': 'index-' + version_key + '.html'})
-
-            # Delete all objects in this version
-            delete_response = client.delete_objects(
-                Bucket=bucket_name,
-                Delete={'Objects': delete_keys}
-            )
+    # Display link to version
+    save_hash_cache()
+    print('Version available at https://' + bucket_name + '.s3.amazonaws.com/index-' + version_id + '.html')
+    return version_id
 
-    elif command == 'view':
-        version_id = sys.argv[2] if len(sys.argv) > 2 else sys.exit(PURPOSE)
-        os.startfile('https://' + bucket_name + '.s3.amazonaws.com/' + 'index-' + version_id + '.html')
 
-    else:
-        sys.exit('Error: Unknown command')
+def deploy(version_id):
+    # Copy version index file to index.html
+    client = create_client(region, upload_concurrency, endpoint_url)
+    deploy_version(client, bucket_name, version_id)
+    print('Deployed version ' + version_id)
+
+
+if __name__ == '__main__':
+
+    # Profile option may appear anywhere on the command line
+    profile = None
+    for argument in sys.argv[1:]:
+        if argument in ['--profile', '--profile=table', '--profile=json']:
+            profile = 'json' if argument == '--profile=json' else 'table'
+            sys.argv.remove(argument)
+
+    if len(sys.argv) < 2:
+        sys.exit(PURPOSE)
+
+    try:
+        configure()
+        load_hash_cache()
+
+        command = sys.argv[1]
+        if command == 'list':
+            client = create_client(region, upload_concurrency, endpoint_url)
+
+            # Get version id of currently live version
+            live_version_id = get_live_version_id(client, bucket_name)
+
+            # List all versions on site
+            refresh = '--refresh' in sys.argv[2:]
+            versions = list_versions(client, bucket_name, upload_concurrency, version_cache_file.format(bucket_name), refresh)
+            for version_id, version in versions:
+                current = '*' if version_id == live_version_id else ''
+                print("{0} {1:1}  {2}  {3:>12,}  {4}".format(
+                    version_id, current, version['pushed'][:19], version['size'], version['description']))
+
+        elif command == 'reindex':
+            reindex_html()
+
+        elif command == 'compile':
+            compile_javascript(closure_version)
+
+        elif command == 'build':
+            build()
+
+        elif command == 'pack':
+            pack_website_assets()
+
+        elif command == 'optimize':
+            image_files = [f for f in list_files(website_path + '/assets') if os.path.splitext(f)[1].lower() in image_types]
+            optimize_images(image_files, image_webp)
+
+        elif command == 'watch':
+            watch(closure_version)
+
+        elif command == 'lint':
+            lint()
+
+        elif command == 'push':
+            if len(sys.argv) < 3:
+                sys.exit(PURPOSE)
+            if sys.argv[2:] == ['--resume']:
+                push(None, resume=True)
+            else:
+                push(" ".join(sys.argv[2:]))
+
+        elif command == 'verify':
+            version_id = sys.argv[2] if len(sys.argv) > 2 else sys.exit(PURPOSE)
+            client = create_client(region, upload_concurrency, endpoint_url)
+            problems = verify_version(client, bucket_name, version_id, upload_concurrency)
+            for problem in problems:
+                print(problem)
+            if problems:
+                sys.exit('Version ' + version_id + ' failed verification')
+
+        elif command == 'deploy':
+            deploy(sys.argv[2] if len(sys.argv) > 2 else sys.exit(PURPOSE))
+
+        elif command == 'delete':
+            client = create_client(region, upload_concurrency, endpoint_url)
+
+            # Get version id of current live version
+            live_version_id = get_live_version_id(client, bucket_name)
+
+            # Delete each specified version
+            version_ids = []
+            for version_key in sys.argv[2:]:
+                if version_key == live_version_id:
+                    print(live_version_id + ' is live and will not be deleted')
+                    continue
+                version_ids.append(version_key)
+            delete_versions(client, bucket_name, version_ids, upload_concurrency)
+
+        elif command == 'prune':
+            keep = older_than = None
+            arguments = sys.argv[2:]
+            try:
+                while arguments:
+                    option = arguments.pop(0)
+                    if option == '--keep':
+                        keep = int(arguments.pop(0))
+                    elif option == '--older-than':
+                        older_than = datetime.timedelta(days=float(arguments.pop(0)))
+                    else:
+                        sys.exit(PURPOSE)
+            except (IndexError, ValueError):
+                sys.exit(PURPOSE)
+            if keep is None and older_than is None:
+                sys.exit(PURPOSE)
+
+            client = create_client(region, upload_concurrency, endpoint_url)
+            live_version_id = get_live_version_id(client, bucket_name)
+            version_ids = select_prune_versions(list_index_entries(client, bucket_name), live_version_id, keep, older_than)
+            delete_versions(client, bucket_name, version_ids, upload_concurrency)
+            deleted_count = delete_unreferenced_hashed_files(client, bucket_name, upload_concurrency)
+            print('Deleted {0} unreferenced hashed files'.format(deleted_count))
+
+        elif command == 'serve':
+            port = 8000
+            if len(sys.argv) > 2:
+                if len(sys.argv) != 4 or sys.argv[2] != '--port' or not sys.argv[3].isdigit():
+                    sys.exit(PURPOSE)
+                port = int(sys.argv[3])
+            serve(port)
+
+        elif command == 'view':
+            version_id = sys.argv[2] if len(sys.argv) > 2 else sys.exit(PURPOSE)
+            webbrowser.open('https://' + bucket_name + '.s3.amazonaws.com/' + 'index-' + version_id + '.html')
+
+        else:
+            sys.exit('Error: Unknown command')
+    except WebsiteError as e:
+        sys.exit(str(e))
+
+    save_hash_cache()
+
+    # Display timing report
+    if profile == 'json':
+        print(profiler.report_json())
+    elif profile == 'table':
+        print(profiler.report_table())
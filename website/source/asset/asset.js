@@ -15,6 +15,7 @@ class Asset {
         this.bodytype = bodytype;
         this.data = null;
         this.error = false;
+        this.loaded = false;            // set once loading has completed, whether or not it succeeded
         this.callbacks = [];
     }
 
@@ -47,6 +48,7 @@ class Asset {
         }
 
         function onFinally() {
+            self.loaded = true;
             self.callbacks.forEach(function(callback) {callback(self);});
         }
 
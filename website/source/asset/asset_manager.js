@@ -6,26 +6,73 @@ class AssetManager {
         this.assetPath = "";
         this.assets = {};
         this.reference_counts = {};
+        this.manifest = null;
+        this.manifestPending = false;
+        this.pendingLoads = [];
     }
 
     setPath(path) {
         this.assetPath = path;
     }
 
+    // Load a packed asset manifest generated by 'website.py pack'. Images and JSON listed in the manifest are
+    // then loaded from sprite atlases and bundles rather than individually. Loads requested while the manifest is
+    // loading are deferred until it completes; if the manifest is unavailable assets are loaded individually.
+    loadManifest(url, callback=null) {
+        let self = this;
+        this.manifestPending = true;
+        function onComplete() {
+            self.manifestPending = false;
+            let pendingLoads = self.pendingLoads;
+            self.pendingLoads = [];
+            pendingLoads.forEach(function(load) {load();});
+            if (callback) callback();
+        }
+        fetch(this.assetPath + url)
+            .then(function(response) {return response.ok ? response.json() : null;})
+            .then(function(manifest) {self.manifest = manifest;})
+            .catch(function() {self.manifest = null;})
+            .finally(onComplete);
+    }
+
     loadImage(url, callback) {
-        this.loadAsset(ImageAsset, url, callback);
+        if (this.manifestPending) {
+            this.pendingLoads.push(() => this.loadImage(url, callback));
+            return;
+        }
+        let frame = this.getManifestEntry("images", url);
+        if (frame) {
+            this.loadAsset(SpriteAsset, url, callback, frame);
+        } else {
+            this.loadAsset(ImageAsset, url, callback);
+        }
     }
 
     loadJSON(url, callback) {
-        this.loadAsset(JSONAsset, url, callback);
+        if (this.manifestPending) {
+            this.pendingLoads.push(() => this.loadJSON(url, callback));
+            return;
+        }
+        let entry = this.getManifestEntry("json", url);
+        if (entry) {
+            this.loadAsset(BundledJSONAsset, url, callback, entry);
+        } else {
+            this.loadAsset(JSONAsset, url, callback);
+        }
+    }
+
+    getManifestEntry(type, url) {
+        // Manifest is parsed JSON so its properties must be accessed by name to survive closure compilation
+        if (!this.manifest || !this.manifest[type]) return null;
+        return this.manifest[type][url] || null;
     }
 
-    loadAsset(assetClass, url, callback) {
+    loadAsset(assetClass, url, callback, manifestEntry=null) {
         let asset = this.assets[url];
         if (!asset) {
             // Asset is not loaded so load it now
             let fullPath = this.assetPath + url;
-            asset = new assetClass(fullPath);
+            asset = new assetClass(fullPath, manifestEntry);
             this.assets[url] = asset;
             this.reference_counts[url] = 1;
             asset.load(callback);
@@ -34,13 +81,12 @@ class AssetManager {
             // - loaded successfully; in this case issue the callback immediately
             // - still loading; in this case provide the callback to the asset to issue when load has completed
             // - previous load failed on an error; in this case issue the callback immediately
+            // An image asset's data is set before it has loaded, so the loaded flag rather than the data is checked
             this.reference_counts[url] += 1;
-            if (!asset.error) {
-                if (!asset.data) {
-                    // asset is still loading; append the callback to execute on load completion
-                    if (callback) asset.addCallback(callback);
-                    return;
-                }
+            if (!asset.loaded) {
+                // asset is still loading; append the callback to execute on load completion
+                if (callback) asset.addCallback(callback);
+                return;
             }
 
             // Asset either loaded successfully or failed to load previously; execute the callback immediately
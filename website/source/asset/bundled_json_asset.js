@@ -0,0 +1,34 @@
+// Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+// A JSON file packed into a bundle of JSON files; the bundle maps each file's url to its content
+class BundledJSONAsset extends Asset {
+
+    constructor(url, entry) {
+        super(url, BODY_TYPES.JSON);
+        this.entry = entry;
+        this.bundleLoaded = false;
+    }
+
+    load(callback=null) {
+        let self = this;
+        this.callbacks.push(callback);
+        assetManagerInstance.loadAsset(JSONAsset, this.entry["bundle"], function(bundle) {
+            self.bundleLoaded = true;
+            if (bundle.error) {
+                self.error = true;
+            } else {
+                self.data = bundle.data[self.entry["key"]];
+            }
+            self.loaded = true;
+            self.callbacks.forEach(function(callback) {if (callback) callback(self);});
+        });
+    }
+
+    dispose() {
+        if (this.bundleLoaded) {
+            assetManagerInstance.unloadAsset(this.entry["bundle"]);
+            this.bundleLoaded = false;
+        }
+        super.dispose();
+    }
+}
@@ -11,10 +11,12 @@ class ImageAsset extends Asset {
         this.data = new Image();
         this.callbacks.push(callback);
         function onLoaded() {
+            self.loaded = true;
             self.callbacks.forEach(function(callback) {callback(self);});
         }
         function onError() {
             self.error = true;
+            self.loaded = true;
             self.dispose();
             self.callbacks.forEach(function(callback) {callback(self);});
         }
@@ -0,0 +1,40 @@
+// Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+// An image packed into a sprite atlas; the image is copied out of the atlas into its own canvas once loaded
+class SpriteAsset extends Asset {
+
+    constructor(url, frame) {
+        super(url, null);
+        this.frame = frame;
+        this.atlasLoaded = false;
+    }
+
+    load(callback=null) {
+        let self = this;
+        this.callbacks.push(callback);
+        assetManagerInstance.loadAsset(ImageAsset, this.frame["atlas"], function(atlas) {
+            self.atlasLoaded = true;
+            if (atlas.error) {
+                self.error = true;
+            } else {
+                let width = self.frame["width"];
+                let height = self.frame["height"];
+                let canvas = document.createElement("canvas");
+                canvas.width = width;
+                canvas.height = height;
+                canvas.getContext("2d").drawImage(atlas.data, self.frame["x"], self.frame["y"], width, height, 0, 0, width, height);
+                self.data = canvas;
+            }
+            self.loaded = true;
+            self.callbacks.forEach(function(callback) {if (callback) callback(self);});
+        });
+    }
+
+    dispose() {
+        if (this.atlasLoaded) {
+            assetManagerInstance.unloadAsset(this.frame["atlas"]);
+            this.atlasLoaded = false;
+        }
+        super.dispose();
+    }
+}
@@ -28,6 +28,9 @@ class Main {
 
         // Initialize core systems
         assetManagerInstance.setPath(assetPath);
+        if (window["packedAssets"] === true) {
+            assetManagerInstance.loadManifest("packed/manifest.json");
+        }
         keyboardInstance.attach(canvas);
         mouseInstance.attach(canvas);
         touchInstance.attach(canvas);